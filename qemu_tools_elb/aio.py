@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.aio
+   ``````````````````
+
+   Asynchronous execution of boxes
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import re
+import time
+import asyncio
+import functools
+from gettext import gettext as _
+from .box import BoxRunner
+from .logging import info, debug, get_logger
+from .qmp import QMPClient
+from .telemetry import span, event, start_sampler
+
+READ_SIZE = 64 * 1024
+
+MAX_PARTIAL_LINE = 64 * 1024
+
+class BoxInstance:
+    """Represents a running box.
+
+    The output of QEMU is read in chunks and split into lines. Each line is
+    passed to the callback given at creation, if any. The instance is
+    considered booted once a line of its output matches the ready pattern,
+    or as soon as output is received if there is no pattern. The line being
+    written is matched too, as prompts are not followed by a newline; only
+    its last :data:`MAX_PARTIAL_LINE` bytes are kept.
+
+    :param box: the box which is running
+    :type box: :class:`Box`
+    :param process: the QEMU process
+    :type process: :class:`asyncio.subprocess.Process`
+    :param ready_pattern: regular expression matching the boot completion
+    :type ready_pattern: str
+    :param on_output: function called with the stream name ('stdout' or
+                      'stderr') and each line of output
+    :type on_output: callable
+    :param context: the resources allocated to the instance
+    :type context: :class:`RunContext`
+    """
+    def __init__(self, box, process, ready_pattern=None, on_output=None,
+                 context=None):
+        self._box = box
+        self._logger = get_logger(box.name)
+        self._process = process
+        self._context = context
+        self._ready = re.compile(ready_pattern) if ready_pattern else None
+        self._on_output = on_output
+        self._booted = asyncio.Event()
+        self._exited = asyncio.Event()
+        self._start = time.monotonic()
+        self._has_output = False
+        self._telemetry = {'box': box.name}
+        if context:
+            self._telemetry['instance'] = context.name
+        self._sampler = start_sampler(process.pid, **self._telemetry)
+        self._readers = [
+            asyncio.ensure_future(self._read(process.stdout, 'stdout')),
+            asyncio.ensure_future(self._read(process.stderr, 'stderr')),
+        ]
+        self._waiter = asyncio.ensure_future(self._wait())
+
+    @property
+    def box(self):
+        """Returns the box which is running"""
+        return self._box
+
+    @property
+    def pid(self):
+        """Returns the process identifier of QEMU"""
+        return self._process.pid
+
+    @property
+    def context(self):
+        """Returns the resources allocated to the instance"""
+        return self._context
+
+    @property
+    def qmp_socket(self):
+        """Returns the path to the QMP socket of QEMU"""
+        return self._context.qmp_socket
+
+    @property
+    def returncode(self):
+        """Returns the exit code of QEMU, or None if it is still running"""
+        return self._process.returncode
+
+    def _check_booted(self, text):
+        if self._booted.is_set():
+            return
+        if self._ready is None or self._ready.search(text):
+            self._logger.debug("booted")
+            event('booted', elapsed=time.monotonic() - self._start,
+                  **self._telemetry)
+            self._booted.set()
+
+    def _output(self, name, line):
+        text = line.decode('utf-8', 'replace').rstrip('\r')
+        self._check_booted(text)
+        if self._on_output:
+            self._on_output(name, text)
+
+    async def _read(self, stream, name):
+        partial = b''
+        while True:
+            data = await stream.read(READ_SIZE)
+            if not data:
+                break
+            if not self._has_output:
+                self._has_output = True
+                event('first-output', elapsed=time.monotonic() - self._start,
+                      **self._telemetry)
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()[-MAX_PARTIAL_LINE:]
+            for line in lines:
+                self._output(name, line)
+            if partial:
+                self._check_booted(partial.decode('utf-8', 'replace'))
+        if partial:
+            self._output(name, partial)
+
+    async def _wait(self):
+        await asyncio.gather(*self._readers)
+        await self._process.wait()
+        if self._sampler:
+            self._sampler.stop()
+        event('exit', returncode=self._process.returncode,
+              duration=time.monotonic() - self._start, **self._telemetry)
+        if self._context:
+            self._context.release()
+        self._logger.info(_("exited with code {}").format(self._process.returncode))
+        self._exited.set()
+
+    async def wait_booted(self):
+        """Waits for the box to be booted.
+
+        :returns: True if the box booted, False if it exited before.
+        :rtype: bool
+        """
+        booted = asyncio.ensure_future(self._booted.wait())
+        exited = asyncio.ensure_future(self._exited.wait())
+        await asyncio.wait([booted, exited],
+                           return_when=asyncio.FIRST_COMPLETED)
+        booted.cancel()
+        exited.cancel()
+        return self._booted.is_set()
+
+    async def wait(self):
+        """Waits for QEMU to exit.
+
+        :returns: the exit code of QEMU
+        :rtype: int
+        """
+        await self._exited.wait()
+        return self._process.returncode
+
+    async def connect_qmp(self):
+        """Opens the QMP control channel of QEMU.
+
+        :returns: the connected client
+        :rtype: :class:`QMPClient`
+        """
+        client = QMPClient()
+        await client.connect(self._context.qmp_socket)
+        return client
+
+    def terminate(self):
+        """Asks QEMU to terminate."""
+        if self._process.returncode is None:
+            self._process.terminate()
+
+    def kill(self):
+        """Kills QEMU."""
+        if self._process.returncode is None:
+            self._process.kill()
+
+def _release_context(future):
+    # Releases the resources allocated for a start which has been cancelled
+    if not future.cancelled() and future.exception() is None:
+        future.result().release()
+
+def _release_reservation(scheduler, future):
+    # Releases the reservation of a start which has been cancelled while the
+    # box was admitted
+    if not future.cancelled() and future.exception() is None and \
+       future.result() is not None:
+        scheduler.release(future.result())
+
+class AsyncBoxRunner(BoxRunner):
+    """Run boxes without blocking, using :mod:`asyncio`.
+
+    The command line of QEMU is generated as with :class:`BoxRunner`, but the
+    process is supervised from the event loop, so a single thread can drive
+    many boxes.
+    """
+    async def start(self, box, ready_pattern=None, on_output=None,
+                    restore=True, save=False):
+        """Starts a virtual machine.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+        :param ready_pattern: regular expression matching the boot completion
+        :type ready_pattern: str
+        :param on_output: function called with the stream name and each line
+                          of output
+        :type on_output: callable
+        :param restore: restore the box from its snapshot, if enabled
+        :type restore: bool
+        :param save: prepare the saving of the state of the box, as done by
+                     :meth:`take_snapshot`
+        :type save: bool
+
+        :returns: the running instance
+        :rtype: :class:`BoxInstance`
+        """
+        info("running {}".format(box.description))
+        loop = asyncio.get_running_loop()
+        admission = loop.run_in_executor(None, self._admit, box)
+        try:
+            reservation = await asyncio.shield(admission)
+        except asyncio.CancelledError:
+            admission.add_done_callback(
+                functools.partial(_release_reservation, self._scheduler))
+            raise
+        # Copying images, creating overlays and tap interfaces block, so the
+        # resources are allocated in the executor, like the admission.
+        future = loop.run_in_executor(None,
+                                      self._new_context,
+                                      box,
+                                      reservation,
+                                      restore,
+                                      save)
+        try:
+            context = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(_release_context)
+            raise
+        try:
+            args = await loop.run_in_executor(None,
+                                              self._generate_cmd_line,
+                                              box,
+                                              context)
+            await loop.run_in_executor(None, self._prefetch, box, context)
+            debug("executing '{}'".format(' '.join(args)))
+            with span('spawn', box=box.name, instance=context.name):
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+                try:
+                    self._pin_process(box, process.pid)
+                except BaseException:
+                    process.kill()
+                    await process.wait()
+                    raise
+        except BaseException:
+            context.release()
+            raise
+        instance = BoxInstance(box, process, ready_pattern, on_output, context)
+        if box.cpu_affinity or box.iothread_affinity:
+            try:
+                await self._pin_threads(box, context.qmp_socket)
+            except BaseException:
+                instance.terminate()
+                await instance.wait()
+                raise
+        return instance
+
+    async def run_async(self, box, ready_pattern=None, on_output=None):
+        """Runs a virtual machine until it exits.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+        :param ready_pattern: regular expression matching the boot completion
+        :type ready_pattern: str
+        :param on_output: function called with the stream name and each line
+                          of output
+        :type on_output: callable
+
+        :returns: the exit code of QEMU
+        :rtype: int
+        """
+        instance = await self.start(box, ready_pattern, on_output)
+        try:
+            return await instance.wait()
+        except asyncio.CancelledError:
+            instance.terminate()
+            await instance.wait()
+            raise
+
+    async def take_snapshot(self, box, timeout=300.0):
+        """Boots a box and saves its state once it is ready.
+
+        The box is booted until its ready pattern appears on its console, then
+        its state is migrated to the snapshot file and QEMU is stopped. The
+        drives are written to overlays, which are kept with the state.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param timeout: maximum duration of the boot, in seconds
+        :type timeout: float
+
+        :returns: the saved state
+        :rtype: :class:`Snapshot`
+        """
+        info(_("taking snapshot of {}").format(box.name))
+        try:
+            instance = await self.start(box,
+                                        ready_pattern=box.snapshot_ready_pattern,
+                                        save=True)
+        except BaseException:
+            from .snapshot import remove_uncommitted
+            remove_uncommitted(box)
+            raise
+        snapshot = instance.context.snapshot
+        try:
+            try:
+                booted = await asyncio.wait_for(instance.wait_booted(), timeout)
+            except asyncio.TimeoutError:
+                booted = False
+            if not booted:
+                raise RuntimeError(_("box did not boot"))
+            client = await instance.connect_qmp()
+            try:
+                await client.execute('migrate', uri=snapshot.outgoing_uri)
+                while True:
+                    status = await client.execute('query-migrate')
+                    state = status.get('status')
+                    if state == 'completed':
+                        break
+                    if state in ('failed', 'cancelled'):
+                        raise RuntimeError(_("can not save state of box"))
+                    await asyncio.sleep(0.1)
+                await client.quit()
+            finally:
+                await client.close()
+        except BaseException:
+            snapshot.remove()
+            raise
+        finally:
+            instance.terminate()
+            await instance.wait()
+        snapshot.commit()
+        return snapshot
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.bench
+   ````````````````````
+
+   Boot time benchmarks
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import re
+import math
+import asyncio
+import statistics
+from gettext import gettext as _
+from .aio import AsyncBoxRunner
+from .logging import info, debug
+
+MILESTONES = [
+    ('kernel', r'Booting Linux|Linux version'),
+    ('init', r'Run /sbin/init|Freeing unused kernel'),
+]
+
+DEFAULT_READY_PATTERN = r'login:'
+
+def summarize(samples):
+    """Computes statistics over a list of durations.
+
+    :param samples: the durations, in seconds
+    :type samples: list of float
+
+    :returns: the minimum, median and 95th percentile of the durations
+    :rtype: dict
+    """
+    if not samples:
+        return None
+    values = sorted(samples)
+    rank = max(1, math.ceil(0.95 * len(values)))
+    return {
+        'min': values[0],
+        'median': statistics.median(values),
+        'p95': values[rank - 1],
+    }
+
+class BootBenchmark:
+    """Measures the boot time of a box.
+
+    The box is booted several times without graphics, so that its serial
+    console can be read. The time elapsed since the start of QEMU is recorded
+    for the first line of output and for each milestone seen on the console:
+    start of the kernel, start of init and a ready pattern, after which the
+    virtual machine is terminated.
+
+    :param box: the box to boot
+    :type box: :class:`Box`
+    :param runner: the runner to use
+    :type runner: :class:`AsyncBoxRunner`
+    :param ready_pattern: regular expression matching the end of the boot
+    :type ready_pattern: str
+    :param timeout: maximum duration of a boot, in seconds
+    :type timeout: float
+    """
+    def __init__(self, box, runner=None, ready_pattern=None, timeout=300.0):
+        self._box = box
+        self._runner = runner or AsyncBoxRunner()
+        self._ready_pattern = ready_pattern or DEFAULT_READY_PATTERN
+        self._milestones = [(n, re.compile(p)) for n, p in MILESTONES]
+        self._milestones.append(('ready', re.compile(self._ready_pattern)))
+        self._timeout = timeout
+
+    async def _boot(self):
+        loop = asyncio.get_running_loop()
+        timestamps = {}
+        start = loop.time()
+
+        def on_output(stream, line):
+            now = loop.time() - start
+            timestamps.setdefault('first-output', now)
+            for name, pattern in self._milestones:
+                if name not in timestamps and pattern.search(line):
+                    debug("{}: {} after {:.3f}s".format(self._box.name, name, now))
+                    timestamps[name] = now
+
+        instance = await self._runner.start(self._box,
+                                            ready_pattern=self._ready_pattern,
+                                            on_output=on_output)
+        try:
+            booted = await asyncio.wait_for(instance.wait_booted(), self._timeout)
+        except asyncio.TimeoutError:
+            booted = False
+        if booted:
+            # The ready pattern may be matched on a prompt, which is not
+            # passed to on_output until a newline follows it.
+            timestamps.setdefault('ready', loop.time() - start)
+        instance.terminate()
+        await instance.wait()
+        if not booted:
+            raise RuntimeError(_("box did not boot"))
+        return timestamps
+
+    async def run_async(self, runs=5):
+        """Boots the box several times.
+
+        :param runs: number of boots
+        :type runs: int
+
+        :returns: the report of the benchmark
+        :rtype: dict
+        """
+        # The box is loaded first, or loading it would undo the override.
+        self._box.load()
+        self._box.has_graphics = False
+        samples = []
+        for i in range(runs):
+            info(_("booting {} ({}/{})").format(self._box.name, i + 1, runs))
+            samples.append(await self._boot())
+        names = ['first-output'] + [n for n, p in self._milestones]
+        return {
+            'box': self._box.name,
+            'runs': runs,
+            'ready-pattern': self._ready_pattern,
+            'milestones': {n: summarize([s[n] for s in samples if n in s])
+                           for n in names},
+            'samples': samples,
+        }
+
+    def run(self, runs=5):
+        """Boots the box several times.
+
+        :param runs: number of boots
+        :type runs: int
+
+        :returns: the report of the benchmark
+        :rtype: dict
+        """
+        return asyncio.run(self.run_async(runs))
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -31,22 +31,152 @@
 __docformat__ = 'restructuredtext en'
 
 import os
+import re
+import time
 import shutil
+import fnmatch
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from gettext import gettext as _
-from subprocess import check_call
-from .logging import info, debug
-from .utils import get_data_dir
+from subprocess import check_call, Popen, DEVNULL, STDOUT, PIPE, CalledProcessError
+from .index import BoxIndex, read_sections
+from .logging import info, debug, warning, get_logger
+from .prefetch import prefetch_files
+from .telemetry import span, event, start_sampler
+from .utils import get_data_dir, get_host_memory, get_runtime_dir
+from .utils import get_cache_dir, parse_cpu_list, get_numa_node_cpus
+
+MACHINES = {
+    'x86': [
+        'qemu-system-i386',
+        '-soundhw', 'hda',
+        '-vga', 'std',
+        '-device', 'piix3-usb-uhci',
+    ],
+    'arm': [
+        'qemu-system-arm',
+    ],
+}
+
+MACHINE_TYPES = {
+    'arm': 'versatilepb',
+}
+
+SINGLE_CPU_MACHINE_TYPES = ['versatilepb']
+
+MAX_NET_INTERFACES = 16
+
+# Delay between two attempts to start the boxes of a fleet waiting for host
+# resources, in seconds
+POLL_INTERVAL = 0.5
+
+KVM_HOSTS = {
+    'x86': ['x86_64', 'i386', 'i486', 'i586', 'i686'],
+    'arm': ['armv7l', 'armv8l'],
+}
+
+ACCELERATORS = ['auto', 'kvm', 'tcg']
+
+def is_kvm_usable(arch):
+    """Tells if KVM can run virtual machines of an architecture on the host.
+
+    :param arch: the architecture of the virtual machine
+    :type arch: str
+
+    :rtype: bool
+    """
+    import platform
+    if platform.machine() not in KVM_HOSTS.get(arch, []):
+        return False
+    return os.access('/dev/kvm', os.R_OK | os.W_OK)
+
+DRIVE_PROFILES = {
+    'default': {},
+    'ci-throwaway': {
+        'interface': 'virtio',
+        'cache': 'unsafe',
+        'aio': 'threads',
+        'iothread': True,
+        'discard': 'unmap',
+        'detect-zeroes': 'unmap',
+    },
+    'durable': {
+        'interface': 'virtio',
+        'cache': 'none',
+        'aio': 'native',
+        'iothread': True,
+        'discard': 'ignore',
+        'detect-zeroes': 'off',
+    },
+}
+
+DRIVE_OPTIONS = {
+    'interface': ('DriveInterface', ['ide', 'scsi', 'virtio', 'virtio-scsi']),
+    'cache': ('DriveCache', ['none', 'writeback', 'writethrough',
+                             'directsync', 'unsafe']),
+    'aio': ('DriveAio', ['threads', 'native', 'io_uring']),
+    'discard': ('Discard', ['ignore', 'unmap']),
+    'detect-zeroes': ('DetectZeroes', ['off', 'on', 'unmap']),
+}
+
+def _get_int(parser, section, option, fallback=None):
+    # Empty values, as in the example configuration, mean the option is unset
+    value = parser.get(section, option, fallback='')
+    return parser.getint(section, option) if value.strip() else fallback
+
+def _get_boolean(parser, section, option, fallback=False):
+    value = parser.get(section, option, fallback='')
+    return parser.getboolean(section, option) if value.strip() else fallback
+
+def _read_drive_options(parser, section):
+    options = {}
+    for key, (option, values) in DRIVE_OPTIONS.items():
+        value = parser.get(section, option, fallback=None)
+        if value:
+            options[key] = value
+    value = parser.get(section, 'IOThread', fallback=None)
+    if value:
+        options['iothread'] = parser.getboolean(section, 'IOThread')
+    return options
 
 class BoxManager:
-    """Manages boxes"""
-    def __init__(self):
+    """Manages boxes
+
+    The index of the box configuration files is only read by the methods
+    listing boxes. Looking up a box by its name reads its file directly, so
+    that its cost does not grow with the number of boxes.
+
+    :param index: index of the box configuration files
+    :type index: :class:`BoxIndex`
+    :param jobs: maximum number of directories or files read in parallel
+    :type jobs: int
+    """
+    def __init__(self, index=None, jobs=8):
         self._directories = [os.path.expanduser("~/.local/share/qemu-box/boxes")]
         if 'QEMU_BOXES_PATH' in os.environ:
             self._directories += os.environ['QEMU_BOXES_PATH'].split(':')
+        self._index = index
+        self._jobs = max(1, jobs)
 
-    @staticmethod
-    def _list_boxes(directory):
+    @property
+    def index(self):
+        """Returns the index of the box configuration files, reading it on
+        first use.
+        """
+        if self._index is None:
+            self._index = BoxIndex()
+        return self._index
+
+    def _save_index(self):
+        if self._index is not None:
+            self._index.save()
+
+    def _load_box(self, name, path):
+        return Box(name, loader=lambda: self.index.get_sections(path), path=path)
+
+    def _list_boxes(self, directory):
         """List the boxes available in a directory.
 
         :param directory: path of the directory to inspect.
@@ -56,17 +186,53 @@ class BoxManager:
         :rtype: list of :class:`Box`
         """
         boxes = []
-        if os.path.exists(directory):
-            for entry in os.listdir(directory):
-                path = os.path.join(directory, entry)
-                if os.path.isfile(path):
-                    name, ext = os.path.splitext(entry)
-                    if ext == '.conf':
-                        box = Box(name)
-                        box.load_from_file(path)
-                        boxes.append(box)
+        with span('discover', directory=directory):
+            entries = self.index.list_directory(directory)
+        for name, path in entries.items():
+            boxes.append(self._load_box(name, path))
         return boxes
 
+    def iter_boxes(self, arch=None, pattern=None, origin=None):
+        """Yields the available boxes, as they are found.
+
+        The directories are scanned in parallel, but the boxes are yielded in
+        order of the directories, starting with the farthest member of
+        $QEMU_BOXES_PATH, so that the boxes found first can be used before the
+        end of the scan. If a box is found twice, only the first one is
+        yielded. The boxes of a directory are not sorted.
+
+        :param arch: only yield the boxes of this architecture
+        :type arch: str
+        :param pattern: only yield the boxes which name matches this
+                        shell-style pattern
+        :type pattern: str
+        :param origin: only yield the boxes found in this directory
+        :type origin: str
+
+        :returns: an iterator over the boxes
+        :rtype: iterator of :class:`Box`
+        """
+        directories = list(reversed(self._directories))
+        if origin is not None:
+            origin = os.path.normpath(os.path.expanduser(origin))
+            directories = [d for d in directories if os.path.normpath(d) == origin]
+        names = set()
+        jobs = max(1, min(self._jobs, len(directories)))
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for found in executor.map(self._list_boxes, directories):
+                    found = [b for b in found if b.name not in names]
+                    names.update(b.name for b in found)
+                    if pattern:
+                        found = [b for b in found
+                                 if fnmatch.fnmatchcase(b.name, pattern)]
+                    if arch:
+                        self._load_boxes(found)
+                        found = [b for b in found if b.arch == arch]
+                    yield from found
+        finally:
+            self._save_index()
+
     @property
     def boxes(self):
         """Returns a list of all the available boxes.
@@ -77,17 +243,12 @@ class BoxManager:
         If a box is found twice, the one found in the farthest member of
         $QEMU_BOXES_PATH is selected.
 
+        The directories are scanned in parallel.
+
         :returns: the list of boxes
         :rtype: list of :class:`Box`
         """
-        boxes = []
-        names = []
-        for directory in reversed(self._directories):
-            for box in BoxManager._list_boxes(directory):
-                if box.name not in names:
-                    boxes.append(box)
-                    names.append(box.name)
-        return sorted(boxes, key=lambda b: b.name)
+        return sorted(self.iter_boxes(), key=lambda b: b.name)
 
     @property
     def local_boxes(self):
@@ -96,22 +257,52 @@ class BoxManager:
         :returns: the list of boxes
         :rtype: list of :class:`Box`
         """
-        boxes = BoxManager._list_boxes(self._directories[0])
+        boxes = self._list_boxes(self._directories[0])
+        self._save_index()
         return sorted(boxes, key=lambda b: b.name)
 
+    @property
+    def local_directory(self):
+        """Returns the directory of the local boxes"""
+        return self._directories[0]
+
+    def _load_boxes(self, boxes):
+        boxes = [b for b in boxes if not b.is_loaded]
+        if boxes:
+            jobs = min(self._jobs, len(boxes))
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(Box.load, boxes))
+
+    def preload(self, boxes):
+        """Loads the configuration of several boxes in parallel.
+
+        :param boxes: the boxes to load
+        :type boxes: list of :class:`Box`
+        """
+        self._load_boxes(boxes)
+        self._save_index()
+
     def lookup_by_name(self, name):
         """Search for a box by its name.
 
         :param name: name of the box.
         :type name: str.
 
+        Only the configuration file of the matching box is read, without the
+        index, once one of its attributes is accessed.
+
         :returns: the matching box.
         :rtype: :class:`Box`.
         """
-        for box in self.boxes:
-            if box.name == name:
-                return box
-        raise RuntimeError(_('box not found'))
+        with span('discover', box=name):
+            if name and os.sep not in name:
+                for directory in reversed(self._directories):
+                    path = os.path.join(directory, name + '.conf')
+                    if os.path.isfile(path):
+                        return Box(name,
+                                   loader=lambda: read_sections(path),
+                                   path=path)
+            raise RuntimeError(_('box not found'))
 
     def _create_box_from_file(self, name, template):
         filename = os.path.join(self._directories[0], name + '.conf')
@@ -168,11 +359,45 @@ class BoxManager:
 class Box:
     '''Represents the configuration for a virtual machine
 
+    If a loader is given, the configuration is only loaded on first access to
+    one of its attributes.
+
     :param name: name of the box
     :type name: str
+    :param loader: function returning the configuration options, indexed by
+                   section
+    :type loader: callable
+    :param path: path to the configuration file of the box
+    :type path: str
     '''
-    def __init__(self, name):
+    def __init__(self, name, loader=None, path=None):
         self._name = name
+        self._loader = loader
+        self._path = path
+        if loader is None:
+            self._set_defaults()
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') or self.__dict__.get('_loader') is None:
+            raise AttributeError(attr)
+        self.load()
+        return getattr(self, attr)
+
+    @property
+    def is_loaded(self):
+        """Tells if the configuration of the box has been loaded"""
+        return self._loader is None
+
+    def load(self):
+        """Loads the configuration of the box using its loader, if needed."""
+        loader = self._loader
+        if loader is not None:
+            self._loader = None
+            with span('parse', box=self._name):
+                self._set_defaults()
+                self.load_from_dict(loader())
+
+    def _set_defaults(self):
         self.description = None
         self.base_directory = None
         self.kernel = 'zImage'
@@ -181,159 +406,1336 @@ class Box:
         self.bootable_image = False
         self.has_graphics = True
         self.arch = 'x86'
+        self.machine_type = None
+        self.accel = 'auto'
+        self.tcg_thread = 'multi'
+        self.tb_size = None
         self.cpu = None
+        self.cpus = 1
+        self.sockets = None
+        self.cores = None
+        self.threads = None
+        self.memory = None
+        self.hugepages = None
+        self.mem_prealloc = False
+        self.numa_node = None
+        self.cpu_affinity = None
+        self.iothread_affinity = None
         self.n_net_interfaces = 1
         self.virtual_network = None
+        self.vlan_backend = None
+        self.vde_socket = None
+        self.bridge = None
+        self.nic_model = None
+        self.vhost = None
+        self.net_queues = '1'
+        self.rx_queue_size = None
+        self.tx_queue_size = None
         self.usb_devices = []
         self.usb_drives = []
+        self.drive_profile = 'default'
+        self.drive_options = {}
+        self.usb_drive_profile = 'default'
+        self.usb_drive_options = {}
+        self.overlays = False
+        self.keep_overlays = False
+        self.overlay_directory = None
+        self.prefetch = 'none'
+        self.cache_images = False
+        self.snapshot = False
+        self.snapshot_ready_pattern = 'login:'
+        self.snapshot_directory = None
+        self.console_capture = False
+        self.console_log = None
+        self.console_log_size = 10240
+        self.console_log_backups = 3
+        self.console_buffer_size = 256
+        self.console_triggers = []
 
     @property
     def name(self):
         """Returns the name of the box"""
         return self._name
 
+    @property
+    def path(self):
+        """Returns the path to the configuration file of the box, if any"""
+        return self._path
+
+    @property
+    def origin(self):
+        """Returns the directory the box was found in, if any"""
+        return os.path.dirname(self._path) if self._path else None
+
     def load_from_file(self, filename):
         """Loads a box from a file.
 
         :param filename: path to the file to read configuration from
         :type filename: str
         """
+        self.load_from_dict(read_sections(filename))
+
+    def load_from_dict(self, sections):
+        """Loads a box from a dictionary.
+
+        :param sections: the configuration options, indexed by section
+        :type sections: dict
+        """
         parser = ConfigParser()
-        with open(filename) as f:
-            parser.read_file(f)
+        parser.read_dict(sections)
 
         self.description = parser.get('General', 'Description', fallback=None)
         value = parser.get('General', 'BaseDirectory', fallback='~/build')
         self.base_directory = os.path.expanduser(value)
         self.arch = parser.get('Machine', 'Arch', fallback='x86')
+        self.machine_type = parser.get('Machine', 'MachineType', fallback=None)
+        self.accel = parser.get('Machine', 'Accel', fallback='auto')
+        self.tcg_thread = parser.get('Machine', 'TcgThread', fallback='multi')
+        self.tb_size = _get_int(parser, 'Machine', 'TbSize', fallback=None)
         self.cpu = parser.get('Machine', 'Cpu', fallback=None)
-        self.has_graphics = parser.getboolean('Machine', 'HasGraphics', fallback=True)
+        self.cpus = _get_int(parser, 'Machine', 'Cpus', fallback=1)
+        self.sockets = _get_int(parser, 'Machine', 'Sockets', fallback=None)
+        self.cores = _get_int(parser, 'Machine', 'Cores', fallback=None)
+        self.threads = _get_int(parser, 'Machine', 'Threads', fallback=None)
+        self.memory = _get_int(parser, 'Machine', 'Memory', fallback=None)
+        value = parser.get('Machine', 'HugePages', fallback='')
+        if value.lower() in parser.BOOLEAN_STATES:
+            if parser.BOOLEAN_STATES[value.lower()]:
+                value = '/dev/hugepages'
+            else:
+                value = ''
+        self.hugepages = value or None
+        self.mem_prealloc = _get_boolean(parser,
+                                         'Machine',
+                                         'MemPrealloc',
+                                         fallback=False)
+        self.numa_node = _get_int(parser, 'Machine', 'NumaNode', fallback=None)
+        self.cpu_affinity = parser.get('Machine', 'CpuAffinity', fallback=None)
+        self.iothread_affinity = parser.get('Machine',
+                                            'IOThreadAffinity',
+                                            fallback=None)
+        self.has_graphics = _get_boolean(parser,
+                                         'Machine',
+                                         'HasGraphics',
+                                         fallback=True)
         self.kernel = parser.get('System', 'Kernel', fallback='zImage')
         value = parser.get('System', 'BootOptions', fallback='')
         self.boot_options = value.split()
-        self.bootable_image = parser.getboolean('System', 'BootableImage', fallback=False)
+        self.bootable_image = _get_boolean(parser,
+                                           'System',
+                                           'BootableImage',
+                                           fallback=False)
         value = parser.get('System', 'Drives', fallback='rootfs.ext2')
         self.drives = [os.path.expanduser(p) for p in value.split()]
-        self.n_net_interfaces = parser.getint('Networking',
-                                              'NumberOfInterfaces',
-                                              fallback=1)
+        self.drive_profile = parser.get('System', 'DriveProfile', fallback='default')
+        self.drive_options = _read_drive_options(parser, 'System')
+        self.overlays = _get_boolean(parser,
+                                     'System',
+                                     'Overlays',
+                                     fallback=False)
+        self.keep_overlays = _get_boolean(parser,
+                                          'System',
+                                          'KeepOverlays',
+                                          fallback=False)
+        value = parser.get('System', 'OverlayDirectory', fallback=None)
+        self.overlay_directory = os.path.expanduser(value) if value else None
+        self.prefetch = parser.get('System', 'Prefetch', fallback='none')
+        self.cache_images = _get_boolean(parser,
+                                         'System',
+                                         'CacheImages',
+                                         fallback=False)
+        self.n_net_interfaces = _get_int(parser,
+                                         'Networking',
+                                         'NumberOfInterfaces',
+                                         fallback=1)
         self.vlan_backend = parser.get('Networking',
                                        'VirtualNetwork',
                                        fallback=None)
+        value = parser.get('Networking', 'VdeSocket', fallback=None)
+        self.vde_socket = os.path.expanduser(value) if value else None
+        self.bridge = parser.get('Networking', 'Bridge', fallback=None)
+        self.nic_model = parser.get('Networking', 'Model', fallback=None)
+        self.vhost = _get_boolean(parser, 'Networking', 'Vhost', fallback=None)
+        self.net_queues = parser.get('Networking', 'Queues', fallback='1')
+        self.rx_queue_size = _get_int(parser,
+                                      'Networking',
+                                      'RxQueueSize',
+                                      fallback=None)
+        self.tx_queue_size = _get_int(parser,
+                                      'Networking',
+                                      'TxQueueSize',
+                                      fallback=None)
         value = parser.get('USB', 'Drives', fallback='')
         self.usb_drives = [os.path.expanduser(p) for p in value.split()]
         value = parser.get('USB', 'Devices', fallback='')
         self.usb_devices = value.split()
+        self.usb_drive_profile = parser.get('USB', 'DriveProfile', fallback='default')
+        self.usb_drive_options = _read_drive_options(parser, 'USB')
+        self.snapshot = _get_boolean(parser,
+                                     'Snapshot',
+                                     'Enabled',
+                                     fallback=False)
+        self.snapshot_ready_pattern = parser.get('Snapshot',
+                                                 'ReadyPattern',
+                                                 fallback='login:')
+        value = parser.get('Snapshot', 'Directory', fallback=None)
+        self.snapshot_directory = os.path.expanduser(value) if value else None
+        self.console_capture = _get_boolean(parser,
+                                            'Console',
+                                            'Capture',
+                                            fallback=False)
+        value = parser.get('Console', 'LogFile', fallback=None)
+        self.console_log = os.path.expanduser(value) if value else None
+        self.console_log_size = _get_int(parser,
+                                         'Console',
+                                         'LogSize',
+                                         fallback=10240)
+        self.console_log_backups = _get_int(parser,
+                                            'Console',
+                                            'LogBackups',
+                                            fallback=3)
+        self.console_buffer_size = _get_int(parser,
+                                            'Console',
+                                            'BufferSize',
+                                            fallback=256)
+        if parser.has_section('Triggers'):
+            self.console_triggers = parser.items('Triggers', raw=True)
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def _get_image_format(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    return 'qcow2' if magic == b'QFI\xfb' else 'raw'
+
+class RunContext:
+    """Holds the resources allocated to a running instance of a box.
+
+    :param qmp_socket: path to the QMP socket of the instance
+    :type qmp_socket: str
+    :param scheduler: the scheduler which admitted the instance
+    :type scheduler: :class:`Scheduler`
+    :param reservation: identifier of the host resources reservation
+    :type reservation: str
+    """
+    def __init__(self, qmp_socket, scheduler=None, reservation=None):
+        self.qmp_socket = qmp_socket
+        self.scheduler = scheduler
+        self.reservation = reservation
+        self.overlays = {}
+        self.overlay_directory = None
+        self.keep_overlays = False
+        self.name = None
+        self.images = {}
+        self.image_cache = None
+        self.leases = None
+        self.lease = None
+        self.net_slot = 0
+        self.taps = []
+        self.snapshot = None
+        self.incoming_uri = None
+
+    def release(self):
+        """Releases the resources of the instance, once QEMU exited."""
+        if self.reservation:
+            self.scheduler.release(self.reservation)
+            self.reservation = None
+        if self.taps:
+            from .network import remove_taps
+            remove_taps(self.taps)
+            self.taps = []
+        if self.lease:
+            self.leases.release(self.lease)
+            self.lease = None
+        _remove_file(self.qmp_socket)
+        if self.image_cache:
+            self.image_cache.release(self.name)
+            self.image_cache = None
+        if self.overlay_directory:
+            if self.keep_overlays:
+                info(_("overlays kept in {}").format(self.overlay_directory))
+            else:
+                shutil.rmtree(self.overlay_directory, ignore_errors=True)
 
 class BoxRunner:
-    """Run boxes"""
-    def __init__(self):
+    """Run boxes
+
+    Each virtual machine is given a QMP control socket, located in the
+    runtime directory, which can be used with :class:`QMPClient`.
+
+    If snapshots are enabled for a box and its saved state is still valid,
+    the virtual machine is restored from it instead of booting. Its drives
+    are run on overlays, backed by the ones saved with the state.
+
+    If a scheduler is given, the host resources needed by each box are
+    reserved before starting it.
+
+    If a cache is given, the command line of a box is reused as long as the
+    configuration of the box and its kernel and drive images are unchanged.
+    The parts specific to an instance (QMP socket, overlays and saved state)
+    are never cached.
+
+    If image caching is enabled for a box, its kernel, as well as its drives
+    if they are not written to (overlays or snapshot mode), are run from
+    local copies kept in an image cache.
+
+    Each instance of a box with network interfaces on the tap or vde backend
+    is leased a network slot, from which the MAC addresses and tap interface
+    names of the instance are derived, so that instances running at the same
+    time do not collide. The others use the first slot, as their network is
+    private. The command line returned by :meth:`get_cmd_line` uses the
+    first slot. If a bridge is set for a box using the tap backend, the tap
+    interfaces of its slot which do not exist yet are created and attached
+    to the bridge before starting it, and removed once it exited.
+
+    If the box sets a CPU affinity, each virtual CPU thread is pinned to its
+    own host CPU, using the thread identifiers reported by QMP. The I/O
+    threads are pinned to the host CPUs of the I/O thread affinity.
+
+    :param emulator: program to use instead of the QEMU system emulator
+                     matching the architecture of the box
+    :type emulator: str
+    :param scheduler: the scheduler admitting the boxes on the host
+    :type scheduler: :class:`Scheduler`
+    :param wait: wait for the host resources to be available, instead of
+                 failing
+    :type wait: bool
+    :param cache: the cache of command lines
+    :type cache: :class:`CommandLineCache`
+    :param image_cache: the cache of images, instead of the default one
+    :type image_cache: :class:`ImageCache`
+    :param leases: the allocator of network slots, instead of the default
+                   one
+    :type leases: :class:`LeaseAllocator`
+    """
+    def __init__(self, emulator=None, scheduler=None, wait=True, cache=None,
+                 image_cache=None, leases=None):
         self._base_mac_addr = '52:54:00:11:22:33'
         self._vde_socket = '/var/run/vde2/tap0.ctl'
+        self._emulator = emulator
+        self._scheduler = scheduler
+        self._wait = wait
+        self._cache = cache
+        self._image_cache = image_cache
+        self._leases = leases
+        # Contexts are allocated from the threads of an executor by
+        # AsyncBoxRunner, so the counter and the lazy attributes are shared.
+        self._instance_numbers = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def get_cmd_line(self, box):
+        """Returns the command line of QEMU for a box.
+
+        The parts specific to an instance (QMP socket, overlays and saved
+        state) are not included.
+
+        :param box: the box
+        :type box: :class:`Box`
+
+        :returns: the command line
+        :rtype: list of str
+        """
+        return self._generate_cmd_line(box)
+
+    def get_snapshot(self, box, net_slot=None):
+        """Returns the saved state of a box.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param net_slot: network slot of the instance the state is saved
+                         from, instead of the one of the saved state
+        :type net_slot: int
+
+        :returns: the saved state, which may not exist or be outdated.
+        :rtype: :class:`Snapshot`
+        """
+        if box.has_graphics:
+            raise RuntimeError(_("snapshots require a box without graphics"))
+        from .snapshot import Snapshot, compute_fingerprint, get_saved_net_slot
+        if net_slot is None:
+            net_slot = get_saved_net_slot(box)
+        args = self._generate_base_cmd_line(box)
+        args += self._generate_net_args(box, net_slot)
+        fingerprint = compute_fingerprint(args, self._get_image_files(box))
+        return Snapshot(box, fingerprint, net_slot)
 
     def run(self, box):
         """Runs a virtual machine.
 
+        If console capture is enabled for a box without graphics, the
+        console is copied to a log file and matched against the triggers of
+        the box. A trigger with an exit code stops the virtual machine.
+
         :param box: the box to run
         :type box: :class:`Box`
+
+        :returns: the exit code of the first trigger with an exit code which
+                  fired, or 0
+        :rtype: int
         """
         info("running {}".format(box.description))
-        args = self._generate_cmd_line(box)
+        capture = box.console_capture
+        if capture and box.has_graphics:
+            warning(_("console capture requires a box without graphics"))
+            capture = False
+        context = self._new_context(box, self._admit(box))
+        try:
+            args = self._generate_cmd_line(box, context)
+            self._prefetch(box, context)
+            debug("executing '{}'".format(' '.join(args)))
+            start = time.monotonic()
+            with span('spawn', box=box.name, instance=context.name):
+                proc = Popen(args, stdout=PIPE if capture else None)
+                try:
+                    self._pin_process(box, proc.pid)
+                    self._pin_threads_sync(box, context)
+                except BaseException:
+                    proc.kill()
+                    proc.wait()
+                    raise
+            sampler = start_sampler(proc.pid, box=box.name, instance=context.name)
+            with proc:
+                console = None
+                try:
+                    if capture:
+                        console = self._capture_console(box, context, proc)
+                    returncode = proc.wait()
+                finally:
+                    if sampler:
+                        sampler.stop()
+                    if console:
+                        console.join()
+            event('exit', box=box.name, instance=context.name,
+                  returncode=returncode, duration=time.monotonic() - start)
+            if console and console.exit_code is not None:
+                return console.exit_code
+            if returncode:
+                raise CalledProcessError(returncode, args)
+            return 0
+        finally:
+            context.release()
+
+    def _capture_console(self, box, context, proc):
+        """Starts capturing the console of an instance of a box.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+        :param proc: the QEMU process, which output is the console
+        :type proc: :class:`subprocess.Popen`
+
+        :returns: the capture
+        :rtype: :class:`ConsoleCapture`
+        """
+        from .console import ConsoleCapture, RotatingLog, parse_trigger
+
+        def on_match(name, line):
+            event('console-match', box=box.name, instance=context.name,
+                  trigger=name)
+            trigger = triggers[name]
+            if trigger.exit_code is None:
+                logger.info(_("matched trigger {}").format(name))
+            else:
+                logger.info(_("matched trigger {}, stopping").format(name))
+                proc.terminate()
+
+        logger = get_logger(box.name)
+
+        triggers = {}
+        for name, value in box.console_triggers:
+            trigger = parse_trigger(name, value)
+            trigger.callback = on_match
+            triggers[name] = trigger
+        path = box.console_log
+        if not path:
+            path = os.path.join(get_cache_dir(), 'consoles', box.name + '.log')
+        log = RotatingLog(path,
+                          box.console_log_size * 1024,
+                          box.console_log_backups)
+        if log.size:
+            log.rotate()
+        logger.debug("capturing console to {}".format(path))
+        return ConsoleCapture(proc.stdout.fileno(),
+                              list(triggers.values()),
+                              log,
+                              box.console_buffer_size * 1024)
+
+    def run_fleet(self, boxes, jobs=None, cpus=None, memory=None,
+                  log_dir=None):
+        """Runs several virtual machines concurrently.
+
+        The boxes are started in order, as long as the number of running
+        boxes, as well as the sum of their virtual CPUs and memory, stay
+        within the given limits. A box may be given several times to run
+        several instances of it.
+
+        :param boxes: the boxes to run
+        :type boxes: list of :class:`Box`
+        :param jobs: maximum number of boxes running at the same time
+        :type jobs: int
+        :param cpus: number of host CPUs available to the boxes
+        :type cpus: int
+        :param memory: amount of host memory available to the boxes, in MiB
+        :type memory: int
+        :param log_dir: directory where to store the output of each box
+        :type log_dir: str
+
+        :returns: the exit code of each box
+        :rtype: list of int
+        """
+        cpus = cpus or os.cpu_count()
+        memory = memory or get_host_memory()
+        jobs = jobs or len(boxes)
+        pending = []
+        for i, box in enumerate(boxes):
+            needs = self._get_resources(box)
+            if needs[0] > cpus or needs[1] > memory:
+                raise RuntimeError(_("box '{}' exceeds host budget").format(box.name))
+            pending.append((i, box, needs))
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        codes = [None] * len(boxes)
+        running = {}
+        used = [0, 0]
+        try:
+            while pending or running:
+                while pending and len(running) < jobs:
+                    i, box, needs = pending[0]
+                    if used[0] + needs[0] > cpus or used[1] + needs[1] > memory:
+                        break
+                    reservation = None
+                    if self._scheduler:
+                        reservation = self._scheduler.try_admit(box.name, *needs)
+                        if reservation is None:
+                            break
+                    pending.pop(0)
+                    proc = self._spawn_instance(box, i, log_dir, reservation)
+                    proc.start = time.monotonic()
+                    proc.sampler = start_sampler(proc.pid,
+                                                 box=box.name,
+                                                 instance=proc.context.name)
+                    running[proc.pid] = (i, box, needs, proc)
+                    used = [used[0] + needs[0], used[1] + needs[1]]
+                if not running:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                pid, status = os.waitpid(-1, 0)
+                if pid not in running:
+                    continue
+                i, box, needs, proc = running.pop(pid)
+                if proc.sampler:
+                    proc.sampler.stop()
+                proc.context.release()
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                event('exit', box=box.name, instance=proc.context.name,
+                      returncode=proc.returncode,
+                      duration=time.monotonic() - proc.start)
+                codes[i] = proc.returncode
+                used = [used[0] - needs[0], used[1] - needs[1]]
+                logger = get_logger(box.name)
+                if proc.returncode:
+                    logger.error(_("#{} exited with code {}").format(i, proc.returncode))
+                else:
+                    logger.info(_("#{} exited").format(i))
+        except BaseException:
+            for i, box, needs, proc in running.values():
+                get_logger(box.name).warning(_("terminating #{}").format(i))
+                proc.terminate()
+            for i, box, needs, proc in running.values():
+                proc.wait()
+                if proc.sampler:
+                    proc.sampler.stop()
+                proc.context.release()
+            raise
+        return codes
+
+    def _spawn_instance(self, box, index, log_dir, reservation=None):
+        context = self._new_context(box, reservation)
+        try:
+            args = self._generate_cmd_line(box, context)
+            self._prefetch(box, context)
+            get_logger(box.name).info("starting #{}".format(index))
+            debug("executing '{}'".format(' '.join(args)))
+            with span('spawn', box=box.name, instance=context.name):
+                if log_dir:
+                    path = os.path.join(log_dir, "{}-{}.log".format(box.name, index))
+                    with open(path, 'wb') as f:
+                        proc = Popen(args, stdin=DEVNULL, stdout=f, stderr=STDOUT)
+                else:
+                    proc = Popen(args, stdin=DEVNULL)
+                try:
+                    self._pin_process(box, proc.pid)
+                    self._pin_threads_sync(box, context)
+                except BaseException:
+                    proc.kill()
+                    proc.wait()
+                    raise
+        except BaseException:
+            context.release()
+            raise
+        proc.context = context
+        return proc
+
+    @staticmethod
+    def find_qmp_sockets(name):
+        """Returns the QMP sockets of the running instances of a box.
+
+        :param name: name of the box
+        :type name: str
+
+        :returns: the paths to the sockets
+        :rtype: list of str
+        """
+        directory = get_runtime_dir()
+        pattern = re.compile(re.escape(name) + r'-\d+-\d+\.qmp$')
+        try:
+            entries = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(directory, e) for e in entries if pattern.match(e))
+
+    def _admit(self, box):
+        """Reserves the host resources needed by a box, if needed.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+
+        :returns: the identifier of the reservation, if any
+        :rtype: str
+        """
+        if not self._scheduler:
+            return None
+        cpus, memory = self._get_resources(box)
+        return self._scheduler.admit(box.name, cpus, memory, self._wait)
+
+    def _new_context(self, box, reservation=None, restore=True, save=False):
+        """Allocates the resources of a new instance of a box.
+
+        The instance is given a unique QMP socket, a network slot if it has
+        network interfaces on a host network and, if enabled, overlays for its
+        drives.
+
+        If snapshots are enabled for the box, its drives are always run on
+        overlays. An instance restored from the saved state is leased the
+        network slot the state was saved from, and its overlays are backed by
+        the saved ones. If the slot is used by another instance, the instance
+        boots instead.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+        :param reservation: identifier of the host resources reservation
+        :type reservation: str
+        :param restore: restore the box from its saved state, if valid
+        :type restore: bool
+        :param save: prepare the saving of the state of the box, which drives
+                     are then written to the overlays kept with the state
+        :type save: bool
+
+        :returns: the resources of the instance
+        :rtype: :class:`RunContext`
+        """
+        instance = "{}-{}-{}".format(box.name,
+                                     os.getpid(),
+                                     next(self._instance_numbers))
+        directory = get_runtime_dir()
+        context = RunContext(os.path.join(directory, instance + '.qmp'),
+                             self._scheduler,
+                             reservation)
+        context.name = instance
+        try:
+            snapshot = None
+            if box.snapshot and restore and not save:
+                snapshot = self.get_snapshot(box)
+                if not snapshot.is_valid():
+                    info(_("no valid snapshot for {}, booting").format(box.name))
+                    snapshot = None
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            # Without a backend, or with the user one, the network of the
+            # instance is private, so its addresses can not collide.
+            if box.n_net_interfaces > 0 and box.vlan_backend in ('tap', 'vde'):
+                with self._lock:
+                    if self._leases is None:
+                        from .lease import LeaseAllocator
+                        self._leases = LeaseAllocator()
+                context.leases = self._leases
+                preferred = snapshot.net_slot if snapshot else None
+                context.lease, context.net_slot = self._leases.acquire(instance,
+                                                                       preferred)
+                if snapshot and context.net_slot != preferred:
+                    info(_("snapshot of {} in use, booting").format(box.name))
+                    snapshot = None
+            if box.vlan_backend == 'tap' and box.bridge:
+                self._provision_taps(box, context)
+            if box.cache_images:
+                self._checkout_images(box,
+                                      instance,
+                                      context,
+                                      not save and snapshot is None)
+            if save:
+                context.snapshot = self.get_snapshot(box, context.net_slot)
+                context.snapshot.prepare()
+                self._create_snapshot_overlays(box, context)
+            elif box.overlays or box.snapshot:
+                self._create_overlays(box, instance, context, snapshot)
+            if snapshot:
+                info(_("restoring {} from snapshot").format(box.name))
+                context.incoming_uri = snapshot.incoming_uri
+        except BaseException:
+            context.release()
+            raise
+        return context
+
+    def _provision_taps(self, box, context):
+        """Creates the missing tap interfaces of an instance of a box.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+        """
+        from .network import get_tap_name, add_taps
+        taps = [get_tap_name(context.net_slot, i)
+                for i in range(box.n_net_interfaces)]
+        with span('network', box=box.name, instance=context.name):
+            context.taps = add_taps(box.bridge,
+                                    taps,
+                                    user=os.getuid(),
+                                    multi_queue=self._get_net_queues(box) > 1)
+
+    def _get_drives(self, box):
+        drives = [('system', i) for i in range(len(box.drives))]
+        drives += [('usb', i) for i in range(len(box.usb_drives))]
+        return drives
+
+    def _create_overlay(self, base, overlay):
+        args = [
+            'qemu-img', 'create', '-q', '-f', 'qcow2',
+            '-F', _get_image_format(base), '-b', base, overlay,
+        ]
         debug("executing '{}'".format(' '.join(args)))
         check_call(args)
 
-    def _generate_cmd_line(self, box):
+    def _create_overlays(self, box, instance, context, snapshot=None):
+        """Creates copy-on-write overlays for the drives of a box.
+
+        Each drive image is used read-only as the backing file of a thin qcow2
+        image, so that several instances can share it.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+        :param instance: name of the instance
+        :type instance: str
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+        :param snapshot: the saved state the instance is restored from, which
+                         overlays are used instead of the drive images
+        :type snapshot: :class:`Snapshot`
+        """
+        directory = box.overlay_directory
+        if not directory:
+            directory = os.path.join(get_cache_dir(), 'overlays')
+        context.overlay_directory = os.path.join(directory, instance)
+        context.keep_overlays = box.keep_overlays
+        os.makedirs(context.overlay_directory)
+        for bus, i in self._get_drives(box):
+            overlay = os.path.join(context.overlay_directory,
+                                   "{}-{}.qcow2".format(bus, i))
+            if snapshot:
+                base = snapshot.get_disk(bus, i)
+            else:
+                base = os.path.abspath(self._get_image_path(box, bus, i, context))
+            self._create_overlay(base, overlay)
+            context.overlays[(bus, i)] = overlay
+
+    def _create_snapshot_overlays(self, box, context):
+        """Creates the overlays kept with the saved state of a box, which
+        its drives are written to until the state is saved.
+
+        They are backed by the drive images themselves, rather than their
+        copies in the image cache, which do not outlive the instance.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+        """
+        for bus, i in self._get_drives(box):
+            overlay = context.snapshot.get_disk(bus, i)
+            base = os.path.abspath(self._get_image_path(box, bus, i))
+            self._create_overlay(base, overlay)
+            context.overlays[(bus, i)] = overlay
+
+    def _checkout_images(self, box, instance, context, drives=True):
+        """Substitutes local copies from the image cache for the kernel and
+        the drives of a box which are not written to.
+
+        When a box is restored from its saved state, or saved, its drives are
+        replaced by the overlays of the state, so only the kernel is used.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+        :param instance: name of the instance
+        :type instance: str
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+        :param drives: substitute the drives too
+        :type drives: bool
+        """
+        with self._lock:
+            if self._image_cache is None:
+                from .imagecache import ImageCache
+                self._image_cache = ImageCache()
+        context.image_cache = self._image_cache
+        images = []
+        if not box.bootable_image:
+            images.append(('kernel', 0))
+        if not drives:
+            debug("not caching drives of {}, run from its state".format(box.name))
+        elif (box.overlays and not box.keep_overlays) or box.snapshot:
+            images += [('system', i) for i in range(len(box.drives))]
+            images += [('usb', i) for i in range(len(box.usb_drives))]
+        else:
+            debug("not caching writable drives of {}".format(box.name))
+        for bus, i in images:
+            path = self._get_image_path(box, bus, i)
+            name = "{}-{}-{}".format(bus, i, os.path.basename(path))
+            with span('image-cache', box=box.name, path=path):
+                context.images[(bus, i)] = self._image_cache.checkout(path,
+                                                                      instance,
+                                                                      name)
+
+    def _prefetch(self, box, context=None):
+        """Loads the kernel and drive images of a box into the page cache,
+        as set by its configuration.
+
+        :param box: the box to run
+        :type box: :class:`Box`
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+        """
+        if box.prefetch != 'none':
+            debug("prefetching images of {}".format(box.name))
+            with span('prefetch', box=box.name, mode=box.prefetch):
+                prefetch_files(self._get_image_files(box, context), box.prefetch)
+
+    def _get_resources(self, box):
+        """Returns the host resources needed by a box.
+
+        :param box: the box
+        :type box: :class:`Box`
+
+        :returns: the number of virtual CPUs and the memory size in MiB
+        :rtype: tuple
+        """
+        memory = {
+            'arm': 256,
+        }
+        if box.cpus < 1:
+            raise RuntimeError(_("invalid number of CPUs"))
+        return box.cpus, box.memory or memory.get(box.arch, 128)
+
+    def _get_host_cpus(self, box):
+        """Returns the host CPUs a box is pinned to.
+
+        :param box: the box
+        :type box: :class:`Box`
+
+        :returns: the CPU numbers, or None if the box is not pinned
+        :rtype: set of int
+        """
+        if box.cpu_affinity:
+            return parse_cpu_list(box.cpu_affinity)
+        if box.numa_node is not None:
+            return get_numa_node_cpus(box.numa_node)
+        return None
+
+    async def _pin_threads(self, box, qmp_socket):
+        """Pins the virtual CPU and I/O threads of QEMU.
+
+        Each virtual CPU thread is pinned to its own CPU of the CPU affinity
+        of the box, and the I/O threads to the CPUs of its I/O thread
+        affinity.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param qmp_socket: path to the QMP socket of QEMU
+        :type qmp_socket: str
+        """
+        from .qmp import QMPClient
+        client = QMPClient()
+        await client.connect(qmp_socket)
+        try:
+            if box.cpu_affinity:
+                cpus = sorted(parse_cpu_list(box.cpu_affinity))
+                for vcpu in await client.execute('query-cpus-fast'):
+                    cpu = cpus[vcpu['cpu-index'] % len(cpus)]
+                    debug("pinning vCPU {} of {} to CPU {}".format(
+                        vcpu['cpu-index'], box.name, cpu))
+                    os.sched_setaffinity(vcpu['thread-id'], {cpu})
+            if box.iothread_affinity:
+                cpus = parse_cpu_list(box.iothread_affinity)
+                for iothread in await client.execute('query-iothreads'):
+                    os.sched_setaffinity(iothread['thread-id'], cpus)
+        finally:
+            await client.close()
+
+    def _pin_threads_sync(self, box, context):
+        if box.cpu_affinity or box.iothread_affinity:
+            import asyncio
+            asyncio.run(self._pin_threads(box, context.qmp_socket))
+
+    def _pin_process(self, box, pid):
+        """Pins QEMU to the host CPUs of a box.
+
+        The affinity is set once QEMU is spawned, as running code in the child
+        before it executes QEMU is not safe in a program with threads. The
+        threads already started by QEMU are pinned too, the next ones inherit
+        the affinity. Memory is bound to the NUMA node by QEMU itself.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param pid: the process identifier of QEMU
+        :type pid: int
+        """
+        cpus = self._get_host_cpus(box)
+        if cpus is None:
+            return
+        pinned = set()
+        while True:
+            try:
+                tids = set(int(t) for t in os.listdir("/proc/{}/task".format(pid)))
+            except FileNotFoundError:
+                return
+            tids -= pinned
+            if not tids:
+                return
+            for tid in tids:
+                try:
+                    os.sched_setaffinity(tid, cpus)
+                except ProcessLookupError:
+                    pass
+                except OSError as e:
+                    raise RuntimeError(_("can not pin box to CPUs: {}").format(e))
+            pinned |= tids
+
+    def _resolve_path(self, box, path):
+        if not os.path.isabs(path):
+            return os.path.join(box.base_directory, path)
+        return path
+
+    def _get_image_path(self, box, bus, index, context=None):
+        """Returns the path to the kernel or a drive image of a box.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param bus: 'kernel', 'system' or 'usb'
+        :type bus: str
+        :param index: index of the drive on its bus
+        :type index: int
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+
+        :returns: the path to the image, or to its cached copy if any
+        :rtype: str
+        """
+        if context and (bus, index) in context.images:
+            return context.images[(bus, index)]
+        if bus == 'kernel':
+            return os.path.join(box.base_directory, box.kernel)
+        drives = box.drives if bus == 'system' else box.usb_drives
+        return self._resolve_path(box, drives[index])
+
+    def _get_image_files(self, box, context=None):
+        """Returns the kernel and drive images used by a box.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+
+        :returns: the paths to the images
+        :rtype: list of str
+        """
+        images = []
+        if not box.bootable_image:
+            images.append(('kernel', 0))
+        images += [('system', i) for i in range(len(box.drives))]
+        images += [('usb', i) for i in range(len(box.usb_drives))]
+        return [self._get_image_path(box, b, i, context) for b, i in images]
+
+    def _get_checksum(self, box):
+        """Computes the checksum of the inputs of the command line of a box.
+
+        :param box: the box
+        :type box: :class:`Box`
+
+        :returns: the checksum
+        :rtype: str
+        """
+        box.load()
+        config = {k: v for k, v in vars(box).items() if not k.startswith('_')}
+        config['name'] = box.name
+        runner = [self._emulator, self._get_accel(box)]
+        from .snapshot import compute_fingerprint
+        return compute_fingerprint([config, runner], self._get_image_files(box))
+
+    def _generate_base_cmd_line(self, box, context=None):
+        """Returns the part of the command line shared by the instances of a
+        box, using the cache if possible.
+
+        The network arguments depend on the slot of the instance and are not
+        part of it.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param context: the resources of the instance
+        :type context: :class:`RunContext`
+
+        :returns: the command line
+        :rtype: list of str
+        """
+        if not self._cache or (context and (context.overlays or context.images)):
+            return self._generate_base_args(box, context)
+        checksum = self._get_checksum(box)
+        args = self._cache.get(box.name, checksum)
+        if args is None:
+            debug("generating command line of {}".format(box.name))
+            args = self._generate_base_args(box, context)
+            self._cache.put(box.name, checksum, args)
+        return args
+
+    def _generate_base_args(self, box, context=None):
         args = self._generate_mach_args(box)
-        args += self._generate_sys_args(box)
-        args += self._generate_net_args(box)
-        args += self._generate_usb_args(box)
+        args += self._generate_sys_args(box, context)
+        args += self._generate_usb_args(box, context)
+        return args
+
+    def _generate_cmd_line(self, box, context=None):
+        with span('argv', box=box.name):
+            args = self._generate_base_cmd_line(box, context)
+            args += self._generate_net_args(box, context.net_slot if context else 0)
+        if context and context.incoming_uri:
+            args += ['-incoming', context.incoming_uri]
+        if context:
+            args += self._generate_qmp_args(context.qmp_socket)
+        return args
+
+    def _get_drive_options(self, box, bus):
+        """Returns the performance options of the drives of a bus.
+
+        The options of the profile are overridden by the options set
+        explicitly.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param bus: 'system' or 'usb'
+        :type bus: str
+
+        :returns: the drive options
+        :rtype: dict
+        """
+        if bus == 'system':
+            profile, overrides = box.drive_profile, box.drive_options
+        else:
+            profile, overrides = box.usb_drive_profile, box.usb_drive_options
+        if profile not in DRIVE_PROFILES:
+            raise RuntimeError(_("unknown drive profile"))
+        options = dict(DRIVE_PROFILES[profile])
+        if self._get_machine_type(box) == 'virt':
+            options.setdefault('interface', 'virtio')
+        options.update(overrides)
+        for key, (option, values) in DRIVE_OPTIONS.items():
+            if key in options and options[key] not in values:
+                raise RuntimeError(_("invalid value for {}").format(option))
+        if bus == 'usb':
+            options.pop('interface', None)
+            options.pop('iothread', None)
+        if options.get('aio') == 'native' and \
+           options.get('cache') not in ('none', 'directsync'):
+            raise RuntimeError(_("native AIO requires cache=none or directsync"))
+        if options.get('iothread') and \
+           options.get('interface') not in ('virtio', 'virtio-scsi'):
+            raise RuntimeError(_("iothreads require a virtio interface"))
+        return options
+
+    def _generate_drive_spec(self, box, bus, index, context):
+        if context and (bus, index) in context.overlays:
+            path = context.overlays[(bus, index)]
+            spec = "file={},format=qcow2".format(path)
+        else:
+            spec = "file={}".format(self._get_image_path(box, bus, index, context))
+        options = self._get_drive_options(box, bus)
+        for key in ('cache', 'aio', 'discard', 'detect-zeroes'):
+            if key in options:
+                spec += ",{}={}".format(key, options[key])
+        return spec
+
+    def _generate_drive_args(self, box, context):
+        options = self._get_drive_options(box, 'system')
+        interface = options.get('interface')
+        iothread = options.get('iothread', False)
+        args = []
+        if interface == 'virtio-scsi':
+            controller = 'virtio-scsi-pci,id=scsi0'
+            if iothread:
+                args += ['-object', 'iothread,id=iothread-scsi0']
+                controller += ',iothread=iothread-scsi0'
+            args += ['-device', controller]
+        for i in range(len(box.drives)):
+            spec = self._generate_drive_spec(box, 'system', i, context)
+            if interface == 'virtio':
+                args.append('-drive')
+                args.append("id=disk-{},{},if=none".format(i, spec))
+                device = "virtio-blk-pci,drive=disk-{}".format(i)
+                if iothread:
+                    args += ['-object', "iothread,id=iothread-disk-{}".format(i)]
+                    device += ",iothread=iothread-disk-{}".format(i)
+                args += ['-device', device]
+            elif interface == 'virtio-scsi':
+                args.append('-drive')
+                args.append("id=disk-{},{},if=none".format(i, spec))
+                args.append('-device')
+                args.append("scsi-hd,drive=disk-{},bus=scsi0.0".format(i))
+            elif interface:
+                args.append('-drive')
+                args.append("{},if={}".format(spec, interface))
+            else:
+                args.append('-drive')
+                args.append(spec)
         return args
 
     def _generate_mach_args(self, box):
-        mach_args = {
-            'x86': [
-                'qemu-system-i386', '--enable-kvm',
-                '-soundhw', 'hda',
-                '-vga', 'std',
-                '-device', 'piix3-usb-uhci',
-            ],
-            'arm': [
-                'qemu-system-arm', '-m', '256',
-                '-M', 'versatilepb',
-            ],
-        }
-        if box.arch not in mach_args:
+        if box.arch not in MACHINES:
             raise RuntimeError(_("unsupported architecture"))
-        args = mach_args[box.arch]
+        args = list(MACHINES[box.arch])
+        if self._emulator:
+            args[0] = self._emulator
+        machine_type = self._get_machine_type(box)
+        if machine_type:
+            args += ['-M', machine_type]
+        args += self._generate_accel_args(box)
+        if box.cpu:
+            args += ['-cpu', box.cpu]
+        args += self._generate_smp_args(box)
+        args += self._generate_mem_args(box)
         if not box.has_graphics:
             args.append('-nographic')
         return args
 
-    def _generate_sys_args(self, box):
+    def _get_machine_type(self, box):
+        return box.machine_type or MACHINE_TYPES.get(box.arch)
+
+    def _get_accel(self, box):
+        """Returns the accelerator to run a box with.
+
+        :param box: the box
+        :type box: :class:`Box`
+
+        :returns: 'kvm' or 'tcg'
+        :rtype: str
+        """
+        if box.accel not in ACCELERATORS:
+            raise RuntimeError(_("unknown accelerator"))
+        if box.accel != 'auto':
+            return box.accel
+        return 'kvm' if is_kvm_usable(box.arch) else 'tcg'
+
+    def _generate_accel_args(self, box):
+        accel = self._get_accel(box)
+        if accel == 'kvm':
+            return ['-accel', 'kvm']
+        if box.tcg_thread not in ('multi', 'single'):
+            raise RuntimeError(_("invalid TCG thread mode"))
+        spec = "tcg,thread={}".format(box.tcg_thread)
+        if box.tb_size:
+            spec += ",tb-size={}".format(box.tb_size)
+        return ['-accel', spec]
+
+    def _generate_smp_args(self, box):
+        cpus, memory = self._get_resources(box)
+        if cpus > 1 and self._get_machine_type(box) in SINGLE_CPU_MACHINE_TYPES:
+            raise RuntimeError(_("machine type supports a single CPU"))
+        topology = [('sockets', box.sockets),
+                    ('cores', box.cores),
+                    ('threads', box.threads)]
+        smp = "cpus={}".format(cpus)
+        for key, value in topology:
+            if value is not None:
+                smp += ",{}={}".format(key, value)
+        if smp == 'cpus=1':
+            return []
+        return ['-smp', smp]
+
+    def _generate_mem_args(self, box):
+        cpus, memory = self._get_resources(box)
+        args = ['-m', str(memory)]
+        if box.hugepages:
+            backend = "memory-backend-file,id=ram0,size={}M,mem-path={}"
+            backend = backend.format(memory, box.hugepages)
+        elif box.numa_node is not None:
+            backend = "memory-backend-ram,id=ram0,size={}M".format(memory)
+        else:
+            if box.mem_prealloc:
+                args.append('-mem-prealloc')
+            return args
+        if box.mem_prealloc:
+            backend += ",prealloc=on"
+        if box.numa_node is not None:
+            backend += ",host-nodes={},policy=bind".format(box.numa_node)
+        args += ['-object', backend, '-machine', 'memory-backend=ram0']
+        return args
+
+    def _generate_sys_args(self, box, context=None):
         consoles = {
             'arm': 'ttyAMA0',
         }
+        root_devices = {
+            'virtio': '/dev/vda',
+        }
         args = []
         if not box.bootable_image:
-            options = ['root=/dev/sda rw ', 'video=vesa', 'vga=788']
+            interface = self._get_drive_options(box, 'system').get('interface')
+            root = root_devices.get(interface, '/dev/sda')
+            options = ["root={} rw ".format(root), 'video=vesa', 'vga=788']
             if not box.has_graphics:
                 tty = consoles.get(box.arch, 'ttyS0')
                 options.append("console={}".format(tty))
             options += box.boot_options
             args.append('-kernel')
-            args.append(os.path.join(box.base_directory, box.kernel))
+            args.append(self._get_image_path(box, 'kernel', 0, context))
             args.append('-append')
             args.append(' '.join(options))
-        for drive in box.drives:
-            if not os.path.isabs(drive):
-                path = os.path.join(box.base_directory, drive)
-            else:
-                path = drive
-            args.append('-drive')
-            args.append("file={}".format(path))
+        args += self._generate_drive_args(box, context)
+        if box.snapshot and not (context and context.overlays):
+            # Instances run on overlays, which are discarded
+            args.append('-snapshot')
         return args
 
-    def _generate_net_args(self, box):
+    def _get_net_queues(self, box):
+        """Returns the number of queue pairs of the network interfaces.
+
+        :param box: the box
+        :type box: :class:`Box`
+
+        :returns: the number of queue pairs
+        :rtype: int
+        """
+        if box.net_queues == 'auto':
+            return self._get_resources(box)[0]
+        try:
+            queues = int(box.net_queues)
+        except ValueError:
+            raise RuntimeError(_("invalid number of network queues"))
+        if queues < 1:
+            raise RuntimeError(_("invalid number of network queues"))
+        return queues
+
+    def _generate_net_args(self, box, slot=0):
+        """Returns the network arguments of an instance of a box.
+
+        Each interface has its own network backend. The MAC addresses and tap
+        interface names are derived from the network slot of the instance.
+
+        :param box: the box
+        :type box: :class:`Box`
+        :param slot: the network slot of the instance
+        :type slot: int
+
+        :returns: the arguments
+        :rtype: list of str
+        """
         args = []
         vlan_backends = ['vde', 'tap', 'user']
-        if box.vlan_backend:
-            if box.vlan_backend not in vlan_backends:
-                raise RuntimeError(_("unsupported VLAN backend"))
-            netdev_id = "vlan-{}-{}".format(box.vlan_backend, 0)
-            netdev = "{},id={}".format(box.vlan_backend, netdev_id)
-            if box.vlan_backend == 'vde':
-                netdev += ",sock={}".format(self._vde_socket)
-            args.append('-netdev')
-            args.append(netdev)
-
-        for mac in self._generate_mac_addresses(box):
-            device = "rtl8139,mac={}".format(mac)
+        if self._get_machine_type(box) == 'virt':
+            model = box.nic_model or 'virtio-net-pci'
+        else:
+            model = box.nic_model or 'rtl8139'
+        is_virtio = model.startswith('virtio-net')
+        queues = self._get_net_queues(box)
+        if queues > 1 and not (is_virtio and box.vlan_backend == 'tap'):
+            warning(_("multiqueue requires virtio-net and a tap backend"))
+            queues = 1
+        if box.vlan_backend and box.vlan_backend not in vlan_backends:
+            raise RuntimeError(_("unsupported VLAN backend"))
+        if box.vhost and box.vlan_backend not in (None, 'tap'):
+            raise RuntimeError(_("vhost requires a tap backend"))
+        for i, mac in enumerate(self._generate_mac_addresses(box, slot)):
+            device = "{},mac={}".format(model, mac)
             if box.vlan_backend:
+                netdev_id = "vlan-{}-{}".format(box.vlan_backend, i)
+                netdev = "{},id={}".format(box.vlan_backend, netdev_id)
+                if box.vlan_backend == 'vde':
+                    netdev += ",sock={}".format(box.vde_socket or self._vde_socket)
+                if box.vlan_backend == 'tap':
+                    from .network import get_tap_name
+                    netdev += ",ifname={}".format(get_tap_name(slot, i))
+                    if box.bridge:
+                        netdev += ",script=no,downscript=no"
+                    vhost = box.vhost
+                    if vhost is None:
+                        vhost = is_virtio and os.access('/dev/vhost-net',
+                                                        os.R_OK | os.W_OK)
+                    if vhost:
+                        netdev += ",vhost=on"
+                    if queues > 1:
+                        netdev += ",queues={}".format(queues)
+                args.append('-netdev')
+                args.append(netdev)
                 device += ",netdev={}".format(netdev_id)
+            if is_virtio:
+                device += self._generate_virtio_net_options(box, queues)
             args.append('-device')
             args.append(device)
         return args
 
-    def _generate_mac_addresses(self, box):
+    def _generate_virtio_net_options(self, box, queues):
+        options = ''
+        if queues > 1:
+            options += ",mq=on,vectors={}".format(2 * queues + 2)
+        for key, size in (('rx_queue_size', box.rx_queue_size),
+                          ('tx_queue_size', box.tx_queue_size)):
+            if size is None:
+                continue
+            if size < 256 or size > 1024 or size & (size - 1):
+                raise RuntimeError(_("invalid network queue size"))
+            options += ",{}={}".format(key, size)
+        return options
+
+    def _generate_mac_addresses(self, box, slot=0):
+        if box.n_net_interfaces > MAX_NET_INTERFACES:
+            raise RuntimeError(_("too many network interfaces"))
         bytes = [int(h, 16) for h in self._base_mac_addr.split(':')]
+        prefix = ':'.join(["{:02x}".format(b) for b in bytes[:3]])
+        base = (bytes[3] << 16) | (bytes[4] << 8) | bytes[5]
         macs = []
         for i in range(box.n_net_interfaces):
-            mac = ':'.join(["{:02x}".format(b) for b in bytes])
+            value = (base + slot * MAX_NET_INTERFACES + i) & 0xffffff
+            mac = "{}:{:02x}:{:02x}:{:02x}".format(prefix,
+                                                   value >> 16,
+                                                   (value >> 8) & 0xff,
+                                                   value & 0xff)
             macs.append(mac)
-            bytes[-1] += 1
         return macs
 
-    def _generate_usb_args(self, box):
+    def _generate_qmp_args(self, qmp_socket):
+        return ['-qmp', "unix:{},server=on,wait=off".format(qmp_socket)]
+
+    def _generate_usb_args(self, box, context=None):
         args = []
         if box.usb_drives or box.usb_devices:
-            args.append('-usb')
-        for i, drive in enumerate(box.usb_drives):
-            if not os.path.isabs(drive):
-                path = os.path.join(box.base_directory, drive)
+            if self._get_machine_type(box) == 'virt':
+                args += ['-device', 'qemu-xhci']
             else:
-                path = drive
+                args.append('-usb')
+        for i in range(len(box.usb_drives)):
+            spec = self._generate_drive_spec(box, 'usb', i, context)
             args.append('-drive')
-            args.append("id=usb-disk-{},file={},if=none".format(i, path))
+            args.append("id=usb-disk-{},{},if=none".format(i, spec))
             args.append('-device')
             args.append("usb-storage,drive=usb-disk-{}".format(i))
         for device in box.usb_devices:
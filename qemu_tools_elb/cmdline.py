@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.cmdline
+   ``````````````````````
+
+   Persistent cache of QEMU command lines
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+from .utils import JsonCache, get_cache_dir
+
+class CommandLineCache(JsonCache):
+    """Caches the command lines generated for the boxes on disk.
+
+    Each command line is stored along with the checksum of the inputs it was
+    generated from, and is only reused if the checksum is unchanged.
+
+    The cache can be shared between threads.
+
+    :param filename: path to the cache file
+    :type filename: str
+    """
+    VERSION = 1
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = os.path.join(get_cache_dir(), 'cmdlines.json')
+        self._entries = {}
+        super().__init__(filename)
+
+    def _restore(self, data):
+        self._entries = data.get('entries', {})
+
+    def _dump(self):
+        return {'entries': self._entries}
+
+    def get(self, name, checksum):
+        """Returns the cached command line of a box.
+
+        :param name: name of the box
+        :type name: str
+        :param checksum: checksum of the inputs of the command line
+        :type checksum: str
+
+        :returns: a copy of the command line, or None if it is not cached or
+                  outdated
+        :rtype: list of str
+        """
+        entry = self._entries.get(name)
+        if entry and entry['checksum'] == checksum:
+            return list(entry['args'])
+        return None
+
+    def put(self, name, checksum, args):
+        """Stores the command line of a box.
+
+        :param name: name of the box
+        :type name: str
+        :param checksum: checksum of the inputs of the command line
+        :type checksum: str
+        :param args: the command line
+        :type args: list of str
+        """
+        with self._lock:
+            self._entries[name] = {'checksum': checksum, 'args': list(args)}
+            self._set_dirty()
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.console
+   ``````````````````````
+
+   Capture of the serial console of boxes
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import re
+import threading
+from gettext import gettext as _
+from .logging import debug, warning
+
+CHUNK_SIZE = 64 * 1024
+
+MAX_LINE_LENGTH = 64 * 1024
+
+# Numbered backreferences and conditionals, which would refer to the wrong
+# group once the patterns are combined
+NUMBERED_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?\(\d')
+
+class RingBuffer:
+    """Keeps the last bytes written to it.
+
+    :param size: capacity of the buffer, in bytes
+    :type size: int
+    """
+    def __init__(self, size):
+        self._buf = bytearray(size)
+        self._size = size
+        self._pos = 0
+        self._full = False
+        self._written = 0
+
+    @property
+    def written(self):
+        """Number of bytes written since the creation of the buffer."""
+        return self._written
+
+    def write(self, data):
+        """Appends data, overwriting the oldest bytes if needed.
+
+        :param data: the data
+        :type data: bytes
+        """
+        self._written += len(data)
+        if len(data) > self._size:
+            self._pos = (self._pos + len(data) - self._size) % self._size
+            data = data[-self._size:]
+        n = len(data)
+        end = self._pos + n
+        if end <= self._size:
+            self._buf[self._pos:end] = data
+        else:
+            split = self._size - self._pos
+            self._buf[self._pos:] = data[:split]
+            self._buf[:n - split] = data[split:]
+        if end >= self._size:
+            self._full = True
+        self._pos = end % self._size
+
+    def read(self, offset):
+        """Returns the bytes written since an offset.
+
+        :param offset: the offset, as given by :attr:`written`
+        :type offset: int
+
+        :returns: the bytes still in the buffer and the number of bytes
+                  overwritten before they could be read
+        :rtype: tuple
+        """
+        start = max(offset, self._written - self._size)
+        n = self._written - start
+        i = start % self._size
+        if i + n <= self._size:
+            data = bytes(self._buf[i:i + n])
+        else:
+            data = bytes(self._buf[i:] + self._buf[:i + n - self._size])
+        return data, start - offset
+
+    def getvalue(self):
+        """Returns the contents of the buffer, oldest bytes first.
+
+        :rtype: bytes
+        """
+        if not self._full:
+            return bytes(self._buf[:self._pos])
+        return bytes(self._buf[self._pos:] + self._buf[:self._pos])
+
+    def tail(self, n=20):
+        """Returns the last lines of the buffer.
+
+        :param n: the number of lines
+        :type n: int
+
+        :rtype: list of str
+        """
+        text = self.getvalue().decode('utf-8', errors='replace')
+        return text.splitlines()[-n:]
+
+class RotatingLog:
+    """Writes data to a file, which is rotated when it becomes too large.
+
+    On rotation, ``path`` is renamed to ``path.1``, ``path.1`` to ``path.2``
+    and so on, up to the number of backups.
+
+    :param path: path to the file
+    :type path: str
+    :param max_size: maximum size of the file, in bytes, or 0 for no limit
+    :type max_size: int
+    :param backups: number of rotated files to keep
+    :type backups: int
+    """
+    def __init__(self, path, max_size=0, backups=3):
+        self._path = path
+        self._max_size = max_size
+        self._backups = backups
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+
+    @property
+    def size(self):
+        """Size of the current file, in bytes."""
+        return self._size
+
+    def rotate(self):
+        """Starts a new file, keeping the current one as a backup."""
+        self._file.close()
+        for i in range(self._backups - 1, 0, -1):
+            src = "{}.{}".format(self._path, i)
+            if os.path.exists(src):
+                os.replace(src, "{}.{}".format(self._path, i + 1))
+        if self._backups > 0:
+            os.replace(self._path, self._path + '.1')
+        else:
+            os.unlink(self._path)
+        self._file = open(self._path, 'ab')
+        self._size = 0
+
+    def write(self, data):
+        """Appends data to the file.
+
+        :param data: the data
+        :type data: bytes
+        """
+        if self._max_size and self._size and self._size + len(data) > self._max_size:
+            self.rotate()
+        self._file.write(data)
+        self._size += len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class Trigger:
+    """Action taken when a line of the console matches a pattern.
+
+    :param name: name of the trigger
+    :type name: str
+    :param pattern: regular expression matching the line
+    :type pattern: str
+    :param callback: function called with the name of the trigger and the
+                     matching line
+    :type callback: callable
+    :param exit_code: exit code of the run, which is stopped, if not None
+    :type exit_code: int
+    """
+    def __init__(self, name, pattern, callback=None, exit_code=None):
+        self.name = name
+        self.pattern = pattern
+        self.callback = callback
+        self.exit_code = exit_code
+
+def parse_trigger(name, value):
+    """Parses a trigger of a box configuration.
+
+    The value is the regular expression, preceded by the exit code and a
+    colon. The exit code may be empty.
+
+    :param name: name of the trigger
+    :type name: str
+    :param value: the value
+    :type value: str
+
+    :rtype: :class:`Trigger`
+    """
+    code, sep, pattern = value.partition(':')
+    if not sep or not pattern:
+        raise RuntimeError(_("invalid trigger '{}'").format(name))
+    try:
+        exit_code = int(code) if code.strip() else None
+    except ValueError:
+        raise RuntimeError(_("invalid trigger '{}'").format(name))
+    return Trigger(name, pattern, exit_code=exit_code)
+
+class PatternMatcher:
+    """Matches lines against the patterns of several triggers at once.
+
+    The patterns are compiled into a single regular expression, so that the
+    cost of matching does not grow with the number of triggers. Patterns
+    which can not be combined, like those using global inline flags or
+    numbered backreferences, are matched one by one instead. A line may fire
+    several triggers.
+
+    :param triggers: the triggers
+    :type triggers: list of :class:`Trigger`
+    """
+    def __init__(self, triggers):
+        self._triggers = []
+        groups = []
+        for i, trigger in enumerate(triggers):
+            try:
+                regex = re.compile(trigger.pattern.encode(), re.MULTILINE)
+            except re.error as e:
+                raise RuntimeError(_("invalid pattern for trigger '{}': {}").format(trigger.name, e))
+            group = "t{}".format(i)
+            self._triggers.append((group, regex, trigger))
+            groups.append("(?P<{}>{})".format(group, trigger.pattern))
+        self._regex = None
+        if groups and not any(NUMBERED_GROUP_REFERENCE.search(t.pattern) for t in triggers):
+            try:
+                self._regex = re.compile('|'.join(groups).encode(), re.MULTILINE)
+            except re.error as e:
+                debug("matching triggers one by one: {}".format(e))
+
+    @staticmethod
+    def _get_line(lines, m):
+        start = lines.rfind(b'\n', 0, m.start()) + 1
+        end = lines.find(b'\n', m.end())
+        if end < 0:
+            end = len(lines)
+        return start, end
+
+    def _match_each(self, lines):
+        found = {}
+        for i, (group, regex, trigger) in enumerate(self._triggers):
+            pos = 0
+            while True:
+                m = regex.search(lines, pos)
+                if m is None:
+                    break
+                start, end = self._get_line(lines, m)
+                found[(start, i)] = (trigger, lines[start:end])
+                pos = end + 1
+        for key in sorted(found):
+            trigger, line = found[key]
+            yield trigger, line.decode('utf-8', errors='replace').rstrip('\r')
+
+    def match(self, lines):
+        """Finds the lines matching a pattern.
+
+        :param lines: complete lines of text
+        :type lines: bytes
+
+        :returns: the triggers fired, with the matching line
+        :rtype: iterator over tuples
+        """
+        if self._regex is None:
+            yield from self._match_each(lines)
+            return
+        pos = 0
+        while True:
+            m = self._regex.search(lines, pos)
+            if m is None:
+                return
+            start, end = self._get_line(lines, m)
+            line = lines[start:end]
+            text = line.decode('utf-8', errors='replace').rstrip('\r')
+            for group, regex, trigger in self._triggers:
+                if m.group(group) is not None or regex.search(line):
+                    yield trigger, text
+            pos = end + 1
+
+class ConsoleCapture:
+    """Reads the console of a box, in a thread.
+
+    The output is stored in a ring buffer keeping its end, and matched against
+    the patterns of the triggers, including the line being written, so that
+    prompts are seen before a newline follows them. A trigger fires at most
+    once per line. Lines longer than :data:`MAX_LINE_LENGTH` are only matched
+    on their beginning, so that memory usage stays bounded whatever the guest
+    writes.
+
+    The copy of the output to the standard output, if requested, and to the
+    log file is made by a second thread reading the ring buffer, so that a
+    slow terminal or disk never blocks the reading of the console, nor QEMU.
+    Output overwritten before it could be copied is lost.
+
+    Callbacks are called from the reading thread, so they must not block.
+
+    :param fd: file descriptor of the console
+    :type fd: int
+    :param triggers: the triggers
+    :type triggers: list of :class:`Trigger`
+    :param log: the log file
+    :type log: :class:`RotatingLog`
+    :param buffer_size: size of the ring buffer, in bytes
+    :type buffer_size: int
+    :param echo: copy the output to the standard output
+    :type echo: bool
+    """
+    def __init__(self, fd, triggers=None, log=None, buffer_size=256 * 1024,
+                 echo=True):
+        self._fd = fd
+        self._matcher = PatternMatcher(triggers or [])
+        self._log = log
+        self._ring = RingBuffer(buffer_size)
+        self._cond = threading.Condition()
+        self._eof = False
+        self._echo = echo
+        self._pending = bytearray()
+        self._pending_fired = set()
+        self._fired = []
+        self.exit_code = None
+        self._threads = [threading.Thread(target=self._run, daemon=True)]
+        if echo or log:
+            self._threads.append(threading.Thread(target=self._copy, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def ring(self):
+        return self._ring
+
+    @property
+    def fired(self):
+        """Names of the triggers fired so far, in order."""
+        return list(self._fired)
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    data = os.read(self._fd, CHUNK_SIZE)
+                except OSError:
+                    break
+                if not data:
+                    break
+                with self._cond:
+                    self._ring.write(data)
+                    self._cond.notify()
+                self._scan(data)
+            if self._pending:
+                self._fire(bytes(self._pending), self._pending_fired)
+        finally:
+            with self._cond:
+                self._eof = True
+                self._cond.notify()
+
+    def _copy(self):
+        out = os.dup(1) if self._echo else None
+        offset = 0
+        try:
+            while True:
+                with self._cond:
+                    while self._ring.written == offset and not self._eof:
+                        self._cond.wait()
+                    if self._ring.written == offset:
+                        break
+                    data, lost = self._ring.read(offset)
+                    offset = self._ring.written
+                if lost:
+                    warning(_("console output too fast, {} bytes lost").format(lost))
+                if out is not None:
+                    try:
+                        os.write(out, data)
+                    except OSError:
+                        pass
+                if self._log:
+                    self._log.write(data)
+        finally:
+            if out is not None:
+                os.close(out)
+            if self._log:
+                self._log.flush()
+
+    def _scan(self, data):
+        first = data.find(b'\n')
+        if first < 0:
+            if len(self._pending) < MAX_LINE_LENGTH:
+                self._pending += data[:MAX_LINE_LENGTH - len(self._pending)]
+                self._fire(bytes(self._pending), self._pending_fired)
+            return
+        if self._pending:
+            line = bytes(self._pending) + data[:first]
+            self._pending.clear()
+        else:
+            line = data[:first]
+        self._fire(line, self._pending_fired)
+        self._pending_fired = set()
+        end = data.rfind(b'\n')
+        if end > first:
+            self._fire(data[first + 1:end])
+        self._pending += data[end + 1:end + 1 + MAX_LINE_LENGTH]
+        if self._pending:
+            self._fire(bytes(self._pending), self._pending_fired)
+
+    def _fire(self, lines, skip=None):
+        for trigger, line in self._matcher.match(lines):
+            if skip is not None:
+                # Triggers already fired on the beginning of the line
+                if trigger.name in skip:
+                    continue
+                skip.add(trigger.name)
+            debug("console matched trigger {}".format(trigger.name))
+            self._fired.append(trigger.name)
+            if trigger.exit_code is not None and self.exit_code is None:
+                self.exit_code = trigger.exit_code
+            if trigger.callback:
+                trigger.callback(trigger.name, line)
+
+    def join(self):
+        """Waits for the end of the console and closes the log file."""
+        for thread in self._threads:
+            thread.join()
+        if self._log:
+            self._log.close()
+
+# vim: ts=4 sw=4 sts=4 et ai
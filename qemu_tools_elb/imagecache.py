@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.imagecache
+   `````````````````````````
+
+   Local cache of kernel and drive images
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from configparser import ConfigParser
+from contextlib import contextmanager
+from gettext import gettext as _
+from .logging import info, debug
+from .utils import get_cache_dir, is_process_alive, locked_json_state
+
+FICLONE = 0x40049409
+
+CHUNK_SIZE = 1024 * 1024
+
+def _clone_file(src, dst):
+    """Makes a file available at another path, sharing its data if possible.
+
+    A hard link is tried first, then a reflink, then a plain copy.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+class ImageCache:
+    """Keeps local copies of images, addressed by the hash of their contents.
+
+    An image is copied into the cache the first time it is used, and hashed
+    on the way. Identical images, even used by different boxes, are stored
+    once. The modification time, size and inode number of each source file
+    are recorded, so an image is only copied and hashed again when its
+    source changes.
+
+    The images are handed out to each run as hard links, in a directory
+    which is removed once the run is over. An image handed out to a run is
+    never evicted. The other images are evicted, least recently used first,
+    when the size of the cache exceeds its quota.
+
+    The cache defaults to ``$XDG_CACHE_HOME/qemu-box/images``. The quota is
+    read from the ``[Cache]`` section of the ``cache.conf`` file of the
+    directory (key ``Quota``, in MiB) and defaults to 10 GiB. The cache can be
+    shared between processes.
+
+    :param directory: path to the cache directory
+    :type directory: str
+    :param quota: maximum size of the cache, in MiB
+    :type quota: int
+    """
+    VERSION = 1
+    DEFAULT_QUOTA = 10240
+
+    def __init__(self, directory=None, quota=None):
+        if not directory:
+            directory = os.path.join(get_cache_dir(), 'images')
+        self._directory = directory
+        self._quota = (quota or self._read_quota()) * 1024 * 1024
+
+    def _read_quota(self):
+        parser = ConfigParser()
+        parser.read(os.path.join(self._directory, 'cache.conf'))
+        quota = parser.getint('Cache', 'Quota', fallback=None)
+        return quota or self.DEFAULT_QUOTA
+
+    def _path(self, *components):
+        return os.path.join(self._directory, *components)
+
+    @contextmanager
+    def _locked_index(self):
+        with locked_json_state(self._directory, 'index.json') as index:
+            for name in ('objects', 'runs', 'tmp'):
+                os.makedirs(self._path(name), exist_ok=True)
+            if index.get('version') != self.VERSION:
+                index.clear()
+                index['version'] = self.VERSION
+            index.setdefault('sources', {})
+            index.setdefault('objects', {})
+            yield index
+
+    def _run_directory(self, run):
+        return self._path('runs', str(os.getpid()), run)
+
+    def _hand_out(self, index, digest, run, name):
+        """Links an image into the directory of a run, with the index locked.
+
+        :returns: the path to the link, or None if the image is not cached
+        """
+        obj = self._path('objects', digest)
+        if digest not in index['objects'] or not os.path.exists(obj):
+            index['objects'].pop(digest, None)
+            return None
+        directory = self._run_directory(run)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        _clone_file(obj, path)
+        index['objects'][digest]['last_used'] = time.time()
+        return path
+
+    def _copy(self, path):
+        """Copies a file into the temporary directory of the cache.
+
+        :returns: the path to the copy and the hash of its contents
+        """
+        digest = hashlib.sha256()
+        os.makedirs(self._path('tmp'), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix="{}-".format(os.getpid()),
+                                   dir=self._path('tmp'))
+        try:
+            with open(path, 'rb') as fsrc, open(fd, 'wb') as fdst:
+                buf = bytearray(CHUNK_SIZE)
+                with memoryview(buf) as view:
+                    while True:
+                        n = fsrc.readinto(buf)
+                        if not n:
+                            break
+                        digest.update(view[:n])
+                        fdst.write(view[:n])
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return tmp, digest.hexdigest()
+
+    def checkout(self, path, run, name):
+        """Hands out the cached copy of an image to a run.
+
+        The image is copied into the cache first, if needed. The copy must
+        not be modified.
+
+        :param path: path to the image
+        :type path: str
+        :param run: name of the run
+        :type run: str
+        :param name: name of the copy
+        :type name: str
+
+        :returns: the path to the copy
+        :rtype: str
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = [st.st_mtime_ns, st.st_size, st.st_ino]
+        with self._locked_index() as index:
+            entry = index['sources'].get(path)
+            if entry and entry['key'] == key:
+                copy = self._hand_out(index, entry['hash'], run, name)
+                if copy:
+                    debug("image cache hit for {}".format(path))
+                    return copy
+        info(_("caching image {}").format(path))
+        tmp, digest = self._copy(path)
+        try:
+            with self._locked_index() as index:
+                obj = self._path('objects', digest)
+                if digest in index['objects'] and os.path.exists(obj):
+                    debug("{} already cached as {}".format(path, digest))
+                else:
+                    os.chmod(tmp, 0o444)
+                    os.replace(tmp, obj)
+                    index['objects'][digest] = {'size': st.st_size}
+                index['sources'][path] = {'key': key, 'hash': digest}
+                copy = self._hand_out(index, digest, run, name)
+                self._evict(index)
+                return copy
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def release(self, run):
+        """Removes the images handed out to a run.
+
+        :param run: name of the run
+        :type run: str
+        """
+        shutil.rmtree(self._run_directory(run), ignore_errors=True)
+
+    def _remove_stale_files(self):
+        runs = self._path('runs')
+        for pid in os.listdir(runs):
+            if pid.isdigit() and not is_process_alive(int(pid)):
+                debug("removing images of dead process {}".format(pid))
+                shutil.rmtree(os.path.join(runs, pid), ignore_errors=True)
+        tmp = self._path('tmp')
+        for entry in os.listdir(tmp):
+            pid = entry.split('-', 1)[0]
+            if pid.isdigit() and not is_process_alive(int(pid)):
+                os.unlink(os.path.join(tmp, entry))
+
+    def _evict(self, index, quota=None):
+        quota = self._quota if quota is None else quota
+        self._remove_stale_files()
+        objects = index['objects']
+        used = sum(o['size'] for o in objects.values())
+        lru = sorted(objects, key=lambda d: objects[d].get('last_used', 0))
+        for digest in lru:
+            if used <= quota:
+                break
+            obj = self._path('objects', digest)
+            try:
+                if os.stat(obj).st_nlink > 1:
+                    continue
+                os.unlink(obj)
+            except FileNotFoundError:
+                pass
+            debug("evicting image {}".format(digest))
+            used -= objects.pop(digest)['size']
+        sources = index['sources']
+        for path in [p for p, e in sources.items() if e['hash'] not in objects]:
+            del sources[path]
+
+    def prune(self, quota=None):
+        """Evicts images until the size of the cache fits in a quota.
+
+        :param quota: the quota, in MiB, instead of the one of the cache
+        :type quota: int
+        """
+        if quota is not None:
+            quota *= 1024 * 1024
+        with self._locked_index() as index:
+            self._evict(index, quota)
+
+    def status(self):
+        """Returns the usage of the cache.
+
+        :returns: the number of images, their total size and the quota in
+                  bytes, and the number of images in use
+        :rtype: dict
+        """
+        with self._locked_index() as index:
+            objects = index['objects']
+            in_use = 0
+            for digest in objects:
+                try:
+                    if os.stat(self._path('objects', digest)).st_nlink > 1:
+                        in_use += 1
+                except FileNotFoundError:
+                    pass
+            return {
+                'images': len(objects),
+                'size': sum(o['size'] for o in objects.values()),
+                'quota': self._quota,
+                'in-use': in_use,
+            }
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.index
+   ````````````````````
+
+   Persistent index of box configuration files
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+from configparser import ConfigParser
+from .logging import debug
+from .utils import JsonCache, get_cache_dir
+
+def read_sections(filename):
+    """Reads the sections of a box configuration file.
+
+    :param filename: path to the configuration file
+    :type filename: str
+
+    :returns: the options of the file, indexed by section
+    :rtype: dict
+    """
+    parser = ConfigParser()
+    with open(filename) as f:
+        parser.read_file(f)
+    return {s: dict(parser.items(s, raw=True)) for s in parser.sections()}
+
+def _file_key(st):
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+class BoxIndex(JsonCache):
+    """Caches the contents of the box directories on disk.
+
+    The list of configuration files of each directory is kept along with the
+    modification time of the directory, and the parsed sections of each file
+    along with its modification time, size and inode number. Only the
+    directories and files which changed since the last run are read again.
+
+    The index can be shared between threads.
+
+    :param filename: path to the index file
+    :type filename: str
+    """
+    VERSION = 1
+
+    def __init__(self, filename=None):
+        if not filename:
+            filename = os.path.join(get_cache_dir(), 'index.json')
+        self._directories = {}
+        self._files = {}
+        super().__init__(filename)
+
+    def _restore(self, data):
+        self._directories = data.get('directories', {})
+        self._files = data.get('files', {})
+
+    def _dump(self):
+        return {'directories': self._directories, 'files': self._files}
+
+    def list_directory(self, directory):
+        """Lists the box configuration files of a directory.
+
+        :param directory: path of the directory to inspect.
+        :type directory: str.
+
+        :returns: the paths of the configuration files, indexed by box name.
+        :rtype: dict
+        """
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            with self._lock:
+                if self._directories.pop(directory, None) is not None:
+                    self._set_dirty()
+            return {}
+        entry = self._directories.get(directory)
+        if entry and entry['mtime'] == mtime:
+            return entry['boxes']
+        boxes = {}
+        with os.scandir(directory) as it:
+            for e in it:
+                stem, ext = os.path.splitext(e.name)
+                if ext == '.conf' and e.is_file():
+                    boxes[stem] = e.path
+        with self._lock:
+            if entry:
+                for path in set(entry['boxes'].values()) - set(boxes.values()):
+                    self._files.pop(path, None)
+            self._directories[directory] = {'mtime': mtime, 'boxes': boxes}
+            self._set_dirty()
+        return boxes
+
+    def get_sections(self, filename):
+        """Returns the sections of a box configuration file.
+
+        The file is only parsed if it changed since it was last indexed.
+
+        :param filename: path to the configuration file
+        :type filename: str
+
+        :returns: the options of the file, indexed by section
+        :rtype: dict
+        """
+        key = _file_key(os.stat(filename))
+        entry = self._files.get(filename)
+        if entry and entry['key'] == key:
+            return entry['sections']
+        debug("indexing {}".format(filename))
+        sections = read_sections(filename)
+        with self._lock:
+            self._files[filename] = {'key': key, 'sections': sections}
+            self._set_dirty()
+        return sections
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.lease
+   ````````````````````
+
+   Allocation of network resources to running boxes
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from gettext import gettext as _
+from .logging import debug
+from .utils import get_state_dir, is_process_alive, locked_json_state
+
+class LeaseAllocator:
+    """Hands out a network slot to each running instance of a box.
+
+    The MAC addresses, tap interface names and other network endpoints of an
+    instance are derived from its slot, so that instances running at the same
+    time never share them. Slots are stored in a state directory, protected
+    by a lock file, so that all the instances of qemu-box using the same
+    directory get distinct slots. The slots of dead processes are reclaimed.
+
+    As tap interfaces and MAC addresses are visible to the whole host, the
+    directory defaults to $QEMU_BOX_LEASES_DIR, or to the ``leases``
+    directory of the state directory, shared by all the users if the
+    administrator created /run/qemu-box. Invalid leases are discarded.
+
+    :param directory: path to the state directory
+    :type directory: str
+    :param size: number of slots
+    :type size: int
+    """
+    def __init__(self, directory=None, size=4096):
+        shared = False
+        if not directory:
+            directory = os.environ.get('QEMU_BOX_LEASES_DIR', '')
+        if not directory:
+            directory = os.path.join(get_state_dir(), 'leases')
+            shared = True
+        self._directory = directory
+        self._shared = shared
+        self._size = size
+
+    @contextmanager
+    def _locked_state(self):
+        with locked_json_state(self._directory,
+                               'leases.json',
+                               self._shared) as state:
+            leases = state.get('leases')
+            if not isinstance(leases, list):
+                leases = []
+            state['leases'] = [l for l in leases
+                               if self._is_valid(l) and is_process_alive(l['pid'])]
+            yield state
+
+    def _is_valid(self, lease):
+        try:
+            return isinstance(lease['id'], str) and \
+                isinstance(lease['pid'], int) and lease['pid'] > 0 and \
+                isinstance(lease['slot'], int) and 0 <= lease['slot'] < self._size
+        except (TypeError, KeyError):
+            return False
+
+    def acquire(self, instance, preferred=None):
+        """Leases a free slot to an instance of a box.
+
+        :param instance: name of the instance
+        :type instance: str
+        :param preferred: slot to lease, if it is free
+        :type preferred: int
+
+        :returns: the identifier of the lease and the slot
+        :rtype: tuple
+        """
+        with self._locked_state() as state:
+            used = set(l['slot'] for l in state['leases'])
+            slots = range(self._size)
+            if preferred is not None:
+                slots = [preferred] + [s for s in slots if s != preferred]
+            for slot in slots:
+                if slot not in used:
+                    break
+            else:
+                raise RuntimeError(_("no network slot available"))
+            lease = {
+                'id': uuid.uuid4().hex,
+                'pid': os.getpid(),
+                'instance': instance,
+                'slot': slot,
+                'since': time.time(),
+            }
+            state['leases'].append(lease)
+        debug("leased network slot {} to {}".format(slot, instance))
+        return lease['id'], slot
+
+    def release(self, id):
+        """Releases a lease.
+
+        :param id: the identifier of the lease
+        :type id: str
+        """
+        with self._locked_state() as state:
+            state['leases'] = [l for l in state['leases'] if l['id'] != id]
+
+    def leases(self):
+        """Returns the active leases.
+
+        :rtype: list of dict
+        """
+        with self._locked_state() as state:
+            return state['leases']
+
+# vim: ts=4 sw=4 sts=4 et ai
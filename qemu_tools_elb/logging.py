@@ -32,8 +32,9 @@ __docformat__ = 'restructuredtext en'
 
 import os
 import sys
+import json
+import atexit
 import logging
-from colorama import init, Fore
 
 __LOG_LEVELS = {
     'debug': logging.DEBUG,
@@ -42,48 +43,177 @@ __LOG_LEVELS = {
     'error': logging.ERROR,
 }
 
+LOG_FORMATS = ['text', 'json']
+
+LOGGER_NAME = 'qemu-tools-elb'
+
 try:
     __level = os.environ['QEMU_TOOLS_ELB_LOG']
     __level = __LOG_LEVELS[__level.lower()]
 except:
     __level = logging.INFO
 
-__logger = logging.getLogger('qemu-tools-elb')
+__logger = logging.getLogger(LOGGER_NAME)
 __logger.setLevel(__level)
 
-class ColoredFormatter(logging.Formatter):
-    """Add color to messages.
+class TextFormatter(logging.Formatter):
+    """Formats records as "LEVEL: [child: ]message".
 
-    :param fmt: format string
-    :type: str
+    The child is the name of the logger relative to the logger of the
+    package, like the name of a box. The prefixes are computed once per
+    logger and level, so that formatting a record only builds the resulting
+    string.
+
+    :param colored: color messages according to their level
+    :type colored: bool
     """
-    def __init__(self, fmt):
-        logging.Formatter.__init__(self, fmt)
+    def __init__(self, colored=False):
+        logging.Formatter.__init__(self)
+        self._prefixes = {}
+        self._colors = {}
+        self._reset = ''
+        if colored:
+            from colorama import init, Fore
+            init()
+            self._colors = {
+                logging.WARNING: Fore.YELLOW,
+                logging.INFO: Fore.GREEN,
+                logging.DEBUG: Fore.BLUE,
+                logging.CRITICAL: Fore.MAGENTA,
+                logging.ERROR: Fore.RED,
+            }
+            self._reset = Fore.RESET
+
+    def _get_prefix(self, record):
+        prefixes = self._prefixes.get(record.name)
+        if prefixes is None:
+            prefixes = self._prefixes[record.name] = {}
+        prefix = prefixes.get(record.levelno)
+        if prefix is None:
+            prefix = self._colors.get(record.levelno, '') + record.levelname + ': '
+            if record.name.startswith(LOGGER_NAME + '.'):
+                prefix += record.name[len(LOGGER_NAME) + 1:] + ': '
+            prefixes[record.levelno] = prefix
+        return prefix
 
     def format(self, record):
-        colors = {
-            'WARNING': Fore.YELLOW,
-            'INFO': Fore.GREEN,
-            'DEBUG': Fore.BLUE,
-            'CRITICAL': Fore.MAGENTA,
-            'ERROR': Fore.RED,
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            message += '\n' + record.exc_text
+        return self._get_prefix(record) + message + self._reset
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects, with the time, level, logger and
+    message of the record.
+    """
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
         }
-        message = logging.Formatter.format(self, record)
-        return colors[record.levelname] + message + Fore.RESET
-
-def setup_logging():
-    fmt = "%(levelname)s: %(message)s"
-    handler = logging.StreamHandler()
-    if sys.stdout.isatty():
-        formatter = ColoredFormatter(fmt)
-        init()
-    else:
-        formatter = logging.Formatter(fmt)
-
-    handler.setFormatter(formatter)
-    for h in __logger.handlers:
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class _LazyHandler(logging.StreamHandler):
+    # Selects the formatter on first use, so that colorama is only imported
+    # if a message is actually logged to a terminal.
+    def __init__(self, fmt):
+        logging.StreamHandler.__init__(self)
+        self._fmt = fmt
+
+    def format(self, record):
+        if self.formatter is None:
+            if self._fmt == 'json':
+                self.setFormatter(JsonFormatter())
+            else:
+                self.setFormatter(TextFormatter(sys.stdout.isatty()))
+        return logging.StreamHandler.format(self, record)
+
+class _QueueHandler(logging.Handler):
+    # Puts records in a queue, written to the sinks by the thread of a
+    # QueueListener, so that the threads logging never wait for the sinks.
+    # The thread is started by the first record: logging.handlers is slow to
+    # import, and most commands log nothing.
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+        self._handlers = handlers
+        self._queue = None
+        self._listener = None
+
+    def _start(self):
+        import queue
+        from logging.handlers import QueueListener
+        self._queue = queue.SimpleQueue()
+        self._listener = QueueListener(self._queue,
+                                       *self._handlers,
+                                       respect_handler_level=True)
+        self._listener.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        if self._listener is None:
+            self._start()
+        # The message is merged on the calling thread, as its arguments may
+        # change afterwards.
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        self._queue.put_nowait(record)
+
+    def close(self):
+        with self.lock:
+            listener, self._listener = self._listener, None
+        if listener:
+            atexit.unregister(self.close)
+            listener.stop()
+        for handler in self._handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+def setup_logging(filename=None, fmt='text'):
+    """Sets up the logging of messages on the standard error, and to a file.
+
+    Messages are written by a background thread. In the text format, they
+    are colored if the standard output is a terminal. In the JSON format,
+    each message is a JSON object, on a single line.
+
+    :param filename: path to the file, which defaults to the value of
+                     $QEMU_TOOLS_ELB_LOG_FILE
+    :type filename: str
+    :param fmt: the format, 'text' or 'json'
+    :type fmt: str
+    """
+    handlers = [_LazyHandler(fmt)]
+    filename = filename or os.environ.get('QEMU_TOOLS_ELB_LOG_FILE')
+    if filename:
+        handler = logging.FileHandler(filename, delay=True)
+        if fmt == 'json':
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(TextFormatter())
+        handlers.append(handler)
+    for h in list(__logger.handlers):
         __logger.removeHandler(h)
-    __logger.addHandler(handler)
+        h.close()
+    __logger.addHandler(_QueueHandler(handlers))
+
+def get_logger(name=None):
+    """Returns the logger of the package, or one of its children.
+
+    The messages of a child, like the logger of a box, are prefixed by its
+    name.
+
+    :param name: name of the child, relative to the logger of the package
+    :type name: str
+
+    :rtype: :class:`logging.Logger`
+    """
+    return __logger.getChild(name) if name else __logger
 
 def info(message):
     __logger.info(message)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.network
+   ``````````````````````
+
+   Provisioning of bridges and tap interfaces
+
+   The interfaces are configured with the ``ip`` program of iproute2. The
+   state of the host is read once, then all the changes are applied by a
+   single ``ip -batch`` process, whatever the number of interfaces. Only the
+   missing changes are applied, so that each operation can be repeated.
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import json
+from subprocess import run, PIPE
+from gettext import gettext as _
+from .logging import debug
+
+TAP_PREFIX = 'qbox'
+
+def get_tap_name(slot, index):
+    """Returns the name of the tap interface of a network slot.
+
+    :param slot: the network slot
+    :type slot: int
+    :param index: index of the interface in the slot
+    :type index: int
+
+    :rtype: str
+    """
+    return "{}{}t{}".format(TAP_PREFIX, slot, index)
+
+def _ip(*args, input=None):
+    try:
+        proc = run(['ip'] + list(args),
+                   input=input,
+                   stdout=PIPE,
+                   stderr=PIPE,
+                   universal_newlines=True)
+    except FileNotFoundError:
+        raise RuntimeError(_("ip is not installed"))
+    if proc.returncode:
+        raise RuntimeError(_("ip failed: {}").format(proc.stderr.strip()))
+    return proc.stdout
+
+def get_links():
+    """Returns the network interfaces of the host.
+
+    :returns: the details of the interfaces, as given by ``ip -json``, by
+              name
+    :rtype: dict
+    """
+    links = json.loads(_ip('-details', '-json', 'link', 'show') or '[]')
+    return {l['ifname']: l for l in links}
+
+def get_addresses(device):
+    """Returns the global addresses of a network interface.
+
+    :param device: name of the interface
+    :type device: str
+
+    :returns: the addresses, with their prefix length and broadcast address,
+              as accepted by ``ip addr add``
+    :rtype: list of str
+    """
+    addresses = []
+    for link in json.loads(_ip('-json', 'addr', 'show', 'dev', device) or '[]'):
+        for addr in link.get('addr_info', []):
+            if addr.get('scope') != 'global':
+                continue
+            address = "{}/{}".format(addr['local'], addr['prefixlen'])
+            if 'broadcast' in addr:
+                address += " broadcast {}".format(addr['broadcast'])
+            addresses.append(address)
+    return addresses
+
+def run_batch(commands):
+    """Applies commands of ``ip`` using a single process.
+
+    The commands are applied in order, until one fails.
+
+    :param commands: the commands, without the leading ``ip``
+    :type commands: list of str
+    """
+    if not commands:
+        return
+    debug("applying {} network commands".format(len(commands)))
+    _ip('-batch', '-', input='\n'.join(commands) + '\n')
+
+def _get_tap_commands(links, bridge, taps, user=None, group=None,
+                      multi_queue=False):
+    commands = []
+    for name in taps:
+        link = links.get(name)
+        if link is None:
+            command = "tuntap add dev {} mode tap".format(name)
+            if user is not None:
+                command += " user {}".format(user)
+            if group is not None:
+                command += " group {}".format(group)
+            if multi_queue:
+                command += " multi_queue"
+            commands.append(command)
+        elif link.get('master') == bridge and 'UP' in link.get('flags', []):
+            continue
+        commands.append("link set dev {} master {} up".format(name, bridge))
+    return commands
+
+def setup_bridge(bridge, taps=(), iface=None, user=None, group=None,
+                 multi_queue=False):
+    """Creates a bridge and tap interfaces attached to it.
+
+    If a physical interface is given, it is attached to the bridge too, and
+    its addresses are moved to the bridge.
+
+    :param bridge: name of the bridge
+    :type bridge: str
+    :param taps: names of the tap interfaces
+    :type taps: list of str
+    :param iface: name of the physical interface
+    :type iface: str
+    :param user: owner of the tap interfaces
+    :type user: str
+    :param group: group of the tap interfaces
+    :type group: str
+    :param multi_queue: create multiqueue tap interfaces
+    :type multi_queue: bool
+    """
+    links = get_links()
+    commands = []
+    if bridge not in links:
+        commands.append("link add name {} type bridge stp_state 0".format(bridge))
+    commands += _get_tap_commands(links, bridge, taps, user, group, multi_queue)
+    if iface and links.get(iface, {}).get('master') != bridge:
+        if iface not in links:
+            raise RuntimeError(_("unknown interface {}").format(iface))
+        addresses = get_addresses(iface)
+        commands.append("addr flush dev {}".format(iface))
+        commands.append("link set dev {} master {} up".format(iface, bridge))
+        commands += ["addr add {} dev {}".format(a, bridge) for a in addresses]
+    if 'UP' not in links.get(bridge, {}).get('flags', []):
+        commands.append("link set dev {} up".format(bridge))
+    run_batch(commands)
+
+def teardown_bridge(bridge, iface=None):
+    """Removes a bridge and the tap interfaces attached to it.
+
+    If a physical interface is given, it is detached from the bridge and the
+    addresses of the bridge are moved back to it.
+
+    :param bridge: name of the bridge
+    :type bridge: str
+    :param iface: name of the physical interface
+    :type iface: str
+    """
+    links = get_links()
+    commands = []
+    for name, link in links.items():
+        if link.get('master') != bridge:
+            continue
+        if link.get('linkinfo', {}).get('info_kind') == 'tun':
+            commands.append("link del dev {}".format(name))
+    addresses = []
+    if iface and links.get(iface, {}).get('master') == bridge:
+        addresses = get_addresses(bridge)
+        commands.append("link set dev {} nomaster".format(iface))
+    if bridge in links:
+        commands.append("link del dev {}".format(bridge))
+    commands += ["addr add {} dev {}".format(a, iface) for a in addresses]
+    run_batch(commands)
+
+def add_taps(bridge, taps, user=None, group=None, multi_queue=False):
+    """Creates the missing tap interfaces and attaches them to a bridge.
+
+    :param bridge: name of the bridge, which must exist
+    :type bridge: str
+    :param taps: names of the tap interfaces
+    :type taps: list of str
+    :param user: owner of the tap interfaces
+    :type user: str
+    :param group: group of the tap interfaces
+    :type group: str
+    :param multi_queue: create multiqueue tap interfaces
+    :type multi_queue: bool
+
+    :returns: the names of the created tap interfaces
+    :rtype: list of str
+    """
+    links = get_links()
+    if bridge not in links:
+        raise RuntimeError(_("unknown bridge {}").format(bridge))
+    run_batch(_get_tap_commands(links, bridge, taps, user, group, multi_queue))
+    return [t for t in taps if t not in links]
+
+def remove_taps(taps):
+    """Removes tap interfaces, if they exist.
+
+    :param taps: names of the tap interfaces
+    :type taps: list of str
+    """
+    links = get_links()
+    run_batch(["link del dev {}".format(t) for t in taps if t in links])
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.pool
+   ```````````````````
+
+   Pool of pre-booted boxes
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import json
+import socket
+import asyncio
+from gettext import gettext as _
+from .aio import AsyncBoxRunner
+from .box import BoxManager
+from .logging import info, debug, error
+from .utils import get_runtime_dir
+
+def get_default_socket():
+    """Returns the default path to the socket of the pool.
+
+    :rtype: str
+    """
+    return os.path.join(get_runtime_dir(), 'pool.sock')
+
+class BoxPool:
+    """Keeps instances of boxes booted and paused, ready to be handed out.
+
+    Each box is booted without graphics until its ready pattern appears on
+    its console, then paused using QMP. When an instance is handed out, it is
+    resumed and a new one is booted in the background to replace it. The
+    instances of a box run on overlays of its drives, so that they do not
+    share writable images. When an instance of a box fails to start or to
+    boot, the next one is started after a delay, doubled at each
+    consecutive failure.
+
+    :param sizes: number of idle instances to keep, indexed by box name
+    :type sizes: dict
+    :param runner: the runner to use
+    :type runner: :class:`AsyncBoxRunner`
+    :param manager: the manager to look boxes up with
+    :type manager: :class:`BoxManager`
+    :param ready_pattern: regular expression matching the end of the boot
+    :type ready_pattern: str
+    :param timeout: maximum duration of a boot, in seconds
+    :type timeout: float
+    """
+    RETRY_DELAY = 5.0
+    MAX_RETRY_DELAY = 300.0
+
+    def __init__(self, sizes, runner=None, manager=None, ready_pattern=None,
+                 timeout=300.0):
+        self._sizes = dict(sizes)
+        self._runner = runner or AsyncBoxRunner()
+        self._manager = manager or BoxManager()
+        self._ready_pattern = ready_pattern or r'login:'
+        self._timeout = timeout
+        self._idle = {name: asyncio.Queue() for name in self._sizes}
+        self._alive = {name: 0 for name in self._sizes}
+        self._failures = {name: 0 for name in self._sizes}
+        self._instances = set()
+        self._handed_out = set()
+        self._tasks = set()
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _fill(self, name):
+        while self._alive[name] < self._sizes[name]:
+            self._alive[name] += 1
+            self._spawn(self._boot(name))
+
+    async def _replace(self, name):
+        # Replaces an instance which exited, once the delay following the
+        # failures of the box elapsed.
+        failures = self._failures[name]
+        if failures:
+            delay = min(self.RETRY_DELAY * 2 ** (failures - 1),
+                        self.MAX_RETRY_DELAY)
+            debug("retrying {} in {:.0f}s".format(name, delay))
+            await asyncio.sleep(delay)
+        self._alive[name] -= 1
+        self._fill(name)
+
+    async def _boot(self, name):
+        box = self._manager.lookup_by_name(name)
+        box.load()
+        box.has_graphics = False
+        box.overlays = True
+        try:
+            instance = await self._runner.start(box, self._ready_pattern)
+        except Exception as e:
+            error(_("can not start {}: {}").format(name, e))
+            self._failures[name] += 1
+            await self._replace(name)
+            return
+        self._instances.add(instance)
+        self._spawn(self._watch(instance))
+        try:
+            booted = await asyncio.wait_for(instance.wait_booted(), self._timeout)
+            if not booted:
+                raise RuntimeError(_("box did not boot"))
+            client = await instance.connect_qmp()
+            try:
+                await client.stop()
+            finally:
+                await client.close()
+        except Exception as e:
+            error(_("can not prepare {}: {}").format(name, e))
+            self._failures[name] += 1
+            instance.terminate()
+            return
+        self._failures[name] = 0
+        debug("{} ready in pool".format(name))
+        self._idle[name].put_nowait(instance)
+
+    async def _watch(self, instance):
+        await instance.wait()
+        self._instances.discard(instance)
+        if instance in self._handed_out:
+            self._handed_out.discard(instance)
+        else:
+            self._spawn(self._replace(instance.box.name))
+
+    async def acquire(self, name):
+        """Hands out an instance of a box.
+
+        The instance is resumed before being returned. It is no longer part
+        of the pool.
+
+        :param name: name of the box
+        :type name: str
+
+        :returns: the running instance
+        :rtype: :class:`BoxInstance`
+        """
+        if name not in self._idle:
+            raise RuntimeError(_("box not in pool"))
+        while True:
+            instance = await self._idle[name].get()
+            if instance.returncode is None:
+                break
+        self._handed_out.add(instance)
+        self._alive[name] -= 1
+        self._fill(name)
+        try:
+            client = await instance.connect_qmp()
+            try:
+                await client.cont()
+            finally:
+                await client.close()
+        except BaseException:
+            # Nobody would stop an instance which was not handed out.
+            instance.terminate()
+            raise
+        info(_("handing out {} (pid {})").format(name, instance.pid))
+        return instance
+
+    def status(self):
+        """Returns the state of the pool.
+
+        :returns: the number of idle and handed out instances, indexed by box
+        :rtype: dict
+        """
+        status = {}
+        for name in self._sizes:
+            handed_out = [i for i in self._handed_out if i.box.name == name]
+            status[name] = {
+                'size': self._sizes[name],
+                'idle': self._idle[name].qsize(),
+                'handed-out': len(handed_out),
+            }
+        return status
+
+    async def _hand_out(self, name, reader):
+        # Acquires an instance for a client, unless the client disconnects
+        # first, in which case the instance is terminated, as nobody would
+        # stop it.
+        acquire = asyncio.ensure_future(self.acquire(name))
+        disconnect = asyncio.ensure_future(reader.read())
+        try:
+            await asyncio.wait({acquire, disconnect},
+                               return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            acquire.cancel()
+            disconnect.cancel()
+            raise
+        if not disconnect.done():
+            disconnect.cancel()
+            return acquire.result()
+        acquire.cancel()
+        await asyncio.wait({acquire})
+        if not acquire.cancelled() and acquire.exception() is None:
+            instance = acquire.result()
+            info(_("client gone, terminating {} (pid {})").format(name,
+                                                                 instance.pid))
+            instance.terminate()
+        raise ConnectionError(_("client disconnected"))
+
+    async def _handle(self, reader, writer):
+        instance = None
+        try:
+            request = json.loads(await reader.readline())
+            command = request.get('command', 'get')
+            if command == 'get':
+                instance = await self._hand_out(request.get('box'), reader)
+                reply = {
+                    'box': instance.box.name,
+                    'pid': instance.pid,
+                    'qmp_socket': instance.qmp_socket,
+                }
+            elif command == 'status':
+                reply = self.status()
+            else:
+                raise RuntimeError(_("unknown command"))
+        except Exception as e:
+            reply = {'error': str(e)}
+        try:
+            writer.write(json.dumps(reply).encode() + b'\n')
+            await writer.drain()
+        except ConnectionError:
+            if instance:
+                instance.terminate()
+        writer.close()
+
+    async def serve(self, path=None):
+        """Fills the pool and serves requests until cancelled.
+
+        Requests are JSON objects sent on a single line to a Unix socket:
+        ``{"box": <name>}`` to get an instance of a box, replied to with its
+        process identifier and QMP socket, or ``{"command": "status"}``. If
+        the client disconnects before the reply, its instance is terminated.
+
+        :param path: path to the socket of the pool
+        :type path: str
+        """
+        path = path or get_default_socket()
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self._handle, path)
+        for name in self._sizes:
+            self._fill(name)
+        info(_("pool listening on {}").format(path))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+            os.unlink(path)
+            await self.close()
+
+    async def close(self):
+        """Terminates all the instances started by the pool, including the
+        ones which were handed out.
+        """
+        for task in list(self._tasks):
+            task.cancel()
+        instances = list(self._instances)
+        for instance in instances:
+            instance.terminate()
+        for instance in instances:
+            await instance.wait()
+
+def request_instance(name, path=None, command='get', timeout=None):
+    """Asks a pool for an instance of a box.
+
+    :param name: name of the box
+    :type name: str
+    :param path: path to the socket of the pool
+    :type path: str
+    :param command: 'get' or 'status'
+    :type command: str
+    :param timeout: maximum time to wait for the reply, in seconds
+    :type timeout: float
+
+    :returns: the reply of the pool
+    :rtype: dict
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path or get_default_socket())
+    except OSError:
+        sock.close()
+        raise RuntimeError(_("can not connect to pool"))
+    # The pool terminates the instance if the socket is closed on timeout.
+    with sock, sock.makefile('rwb') as f:
+        try:
+            f.write(json.dumps({'command': command, 'box': name}).encode() + b'\n')
+            f.flush()
+            reply = json.loads(f.readline())
+        except TimeoutError:
+            raise RuntimeError(_("timeout waiting for the pool"))
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+    return reply
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.prefetch
+   ```````````````````````
+
+   Warming of the page cache with the images of a box
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from gettext import gettext as _
+from .logging import debug
+
+PREFETCH_MODES = ['none', 'advise', 'read']
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+def _advise(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+def _read_segment(path, offset, length):
+    buf = bytearray(CHUNK_SIZE)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        end = offset + length
+        with memoryview(buf) as view:
+            while offset < end:
+                n = os.preadv(fd, [view[:min(CHUNK_SIZE, end - offset)]], offset)
+                if n == 0:
+                    break
+                offset += n
+    finally:
+        os.close(fd)
+
+def prefetch_files(paths, mode='advise', jobs=8):
+    """Loads files into the page cache of the host.
+
+    With the 'advise' mode, the kernel is asked to read the files ahead in
+    the background, which returns immediately. With the 'read' mode, the
+    files are read, split into segments read in parallel, and the function
+    only returns once they are all in the page cache.
+
+    Missing files are skipped.
+
+    :param paths: the paths to the files
+    :type paths: list of str
+    :param mode: 'none', 'advise' or 'read'
+    :type mode: str
+    :param jobs: maximum number of segments read in parallel
+    :type jobs: int
+    """
+    if mode not in PREFETCH_MODES:
+        raise RuntimeError(_("invalid prefetch mode"))
+    if mode == 'none':
+        return
+    tasks = []
+    for path in dict.fromkeys(paths):
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            debug("not prefetching missing file {}".format(path))
+            continue
+        if mode == 'advise':
+            tasks.append((_advise, path))
+        else:
+            for offset in range(0, size, SEGMENT_SIZE):
+                tasks.append((_read_segment, path, offset, SEGMENT_SIZE))
+    if not tasks:
+        return
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(tasks)))) as executor:
+        futures = [executor.submit(*t) for t in tasks]
+        for future in futures:
+            future.result()
+    debug("prefetched {} segments in {:.3f}s".format(len(tasks),
+                                                     time.monotonic() - start))
+
+# vim: ts=4 sw=4 sts=4 et ai
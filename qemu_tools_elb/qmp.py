@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.qmp
+   ``````````````````
+
+   Client for the QEMU Machine Protocol
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import json
+import asyncio
+from gettext import gettext as _
+from .logging import debug
+
+class QMPError(RuntimeError):
+    """Error returned by QEMU in reply to a command.
+
+    :param error: the error object of the reply
+    :type error: dict
+    """
+    def __init__(self, error):
+        RuntimeError.__init__(self, error.get('desc', _('unknown error')))
+        self.error_class = error.get('class')
+
+class QMPClient:
+    """Talks to a running QEMU using its QMP socket.
+
+    Commands are sent without waiting for the replies of the previous ones,
+    which are matched back using their identifier. Asynchronous events sent by
+    QEMU are queued and can be read using :meth:`events`.
+    """
+    def __init__(self):
+        self._reader = None
+        self._writer = None
+        self._dispatcher = None
+        self._pending = {}
+        self._events = asyncio.Queue()
+        self._next_id = 0
+        self.greeting = None
+
+    async def connect(self, path, timeout=10.0):
+        """Connects to QEMU.
+
+        As QEMU may not have created its socket yet, the connection is retried
+        until the timeout expires.
+
+        :param path: path to the QMP socket
+        :type path: str
+        :param timeout: time to wait for the socket, in seconds
+        :type timeout: float
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                streams = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() >= deadline:
+                    raise RuntimeError(_("can not connect to QMP socket"))
+                await asyncio.sleep(0.05)
+        self._reader, self._writer = streams
+        self.greeting = json.loads(await self._reader.readline())
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await self.execute('qmp_capabilities')
+
+    async def close(self):
+        """Closes the connection."""
+        if self._writer:
+            self._writer.close()
+            await self._dispatcher
+            self._writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _dispatch(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if 'event' in message:
+                    debug("QMP event {}".format(message['event']))
+                    self._events.put_nowait(message)
+                    continue
+                future = self._pending.pop(message.get('id'), None)
+                if future is None or future.cancelled():
+                    continue
+                if 'error' in message:
+                    future.set_exception(QMPError(message['error']))
+                else:
+                    future.set_result(message.get('return'))
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(_("QMP connection closed")))
+            self._pending.clear()
+            self._events.put_nowait(None)
+
+    async def execute(self, command, **arguments):
+        """Executes a command.
+
+        :param command: name of the command
+        :type command: str
+        :param arguments: arguments of the command
+
+        :returns: the value returned by QEMU
+        """
+        if self._writer is None:
+            raise ConnectionError(_("QMP connection closed"))
+        self._next_id += 1
+        request = {'execute': command, 'id': self._next_id}
+        if arguments:
+            request['arguments'] = arguments
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_id] = future
+        self._writer.write(json.dumps(request).encode() + b'\n')
+        await self._writer.drain()
+        return await future
+
+    async def events(self):
+        """Yields the events sent by QEMU, until the connection is closed.
+
+        :returns: an asynchronous iterator over the events
+        """
+        while True:
+            event = await self._events.get()
+            if event is None:
+                break
+            yield event
+
+    async def query_status(self):
+        """Returns the run state of the virtual machine.
+
+        :rtype: dict
+        """
+        return await self.execute('query-status')
+
+    async def stop(self):
+        """Pauses the virtual machine."""
+        await self.execute('stop')
+
+    async def cont(self):
+        """Resumes the virtual machine."""
+        await self.execute('cont')
+
+    async def system_powerdown(self):
+        """Asks the guest to power down."""
+        await self.execute('system_powerdown')
+
+    async def quit(self):
+        """Terminates QEMU immediately."""
+        try:
+            await self.execute('quit')
+        except ConnectionError:
+            pass
+
+    async def device_add(self, driver, id, **properties):
+        """Hot-plugs a device.
+
+        :param driver: name of the device driver
+        :type driver: str
+        :param id: identifier of the new device
+        :type id: str
+        :param properties: properties of the device
+        """
+        await self.execute('device_add', driver=driver, id=id, **properties)
+
+    async def device_del(self, id):
+        """Unplugs a device.
+
+        :param id: identifier of the device
+        :type id: str
+        """
+        await self.execute('device_del', id=id)
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.scheduler
+   ````````````````````````
+
+   Admission control of boxes on the host
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import uuid
+from configparser import ConfigParser
+from contextlib import contextmanager
+from gettext import gettext as _
+from .logging import info, debug
+from .utils import get_host_memory, get_state_dir, is_process_alive, \
+    locked_json_state
+
+class Scheduler:
+    """Shares the host between the boxes run by several processes.
+
+    Each box reserves its virtual CPUs and memory before being started. The
+    reservations are stored in a state directory, protected by a lock file,
+    so that all the instances of qemu-box using the same directory share the
+    same budgets. A box is admitted if its reservation fits in the budgets,
+    otherwise it is queued, or rejected. Reservations of dead processes and
+    invalid ones are discarded.
+
+    Queued boxes are admitted in order of arrival, but a box which fits may
+    go ahead of the boxes queued before it, so that a large box does not
+    hold up the smaller ones. This stops once a queued box has waited for
+    :attr:`BACKFILL_DELAY` seconds, so that the large box is not starved: the
+    boxes ahead of it then drain the host until it fits.
+
+    As the resources of the host are shared by all the users, the directory
+    defaults to $QEMU_BOX_SCHEDULER_DIR, or to the ``scheduler`` directory of
+    the state directory, shared by all the users if the administrator created
+    /run/qemu-box. The budgets are read from the
+    ``[Budget]`` section of the ``budget.conf`` file of the directory (keys
+    ``Cpus`` and ``Memory``, in MiB) and default to the resources of the
+    host.
+
+    :param directory: path to the state directory
+    :type directory: str
+    """
+    POLL_INTERVAL = 0.5
+    BACKFILL_DELAY = 60
+
+    def __init__(self, directory=None):
+        shared = False
+        if not directory:
+            directory = os.environ.get('QEMU_BOX_SCHEDULER_DIR', '')
+        if not directory:
+            directory = os.path.join(get_state_dir(), 'scheduler')
+            shared = True
+        self._directory = directory
+        self._shared = shared
+        self._cpus, self._memory = self._read_budget()
+
+    @property
+    def budget(self):
+        """Returns the number of CPUs and the memory, in MiB, of the host
+        available to the boxes.
+        """
+        return self._cpus, self._memory
+
+    def _read_budget(self):
+        parser = ConfigParser()
+        parser.read(os.path.join(self._directory, 'budget.conf'))
+        cpus = parser.getint('Budget', 'Cpus', fallback=None)
+        memory = parser.getint('Budget', 'Memory', fallback=None)
+        return cpus or os.cpu_count(), memory or get_host_memory()
+
+    @contextmanager
+    def _locked_state(self):
+        with locked_json_state(self._directory,
+                               'state.json',
+                               self._shared) as state:
+            for key in ('running', 'queue'):
+                reservations = state.get(key)
+                if not isinstance(reservations, list):
+                    reservations = []
+                state[key] = [r for r in reservations
+                              if self._is_valid(r) and is_process_alive(r['pid'])]
+            yield state
+
+    def _is_valid(self, reservation):
+        try:
+            return isinstance(reservation['id'], str) and \
+                isinstance(reservation['pid'], int) and reservation['pid'] > 0 and \
+                isinstance(reservation['cpus'], int) and reservation['cpus'] >= 0 and \
+                isinstance(reservation['memory'], int) and reservation['memory'] >= 0 and \
+                isinstance(reservation['since'], (int, float))
+        except (TypeError, KeyError):
+            return False
+
+    def _fits(self, state, cpus, memory):
+        used_cpus = sum(r['cpus'] for r in state['running'])
+        used_memory = sum(r['memory'] for r in state['running'])
+        return used_cpus + cpus <= self._cpus and \
+            used_memory + memory <= self._memory
+
+    def _may_overtake(self, queued):
+        # A box may go ahead of queued boxes while none of them has waited
+        # for too long.
+        now = time.time()
+        return all(now - r['since'] < self.BACKFILL_DELAY for r in queued)
+
+    def _check_budget(self, cpus, memory):
+        if cpus > self._cpus or memory > self._memory:
+            raise RuntimeError(_("box exceeds host budget"))
+
+    def _new_reservation(self, name, cpus, memory):
+        return {
+            'id': uuid.uuid4().hex,
+            'pid': os.getpid(),
+            'box': name,
+            'cpus': cpus,
+            'memory': memory,
+            'since': time.time(),
+        }
+
+    def try_admit(self, name, cpus, memory):
+        """Reserves resources for a box, if they are available now.
+
+        :param name: name of the box
+        :type name: str
+        :param cpus: number of virtual CPUs of the box
+        :type cpus: int
+        :param memory: memory size of the box, in MiB
+        :type memory: int
+
+        :returns: the identifier of the reservation, or None
+        :rtype: str
+        """
+        self._check_budget(cpus, memory)
+        with self._locked_state() as state:
+            if not self._may_overtake(state['queue']) or \
+               not self._fits(state, cpus, memory):
+                return None
+            reservation = self._new_reservation(name, cpus, memory)
+            state['running'].append(reservation)
+            return reservation['id']
+
+    def admit(self, name, cpus, memory, wait=True, timeout=None):
+        """Reserves resources for a box.
+
+        :param name: name of the box
+        :type name: str
+        :param cpus: number of virtual CPUs of the box
+        :type cpus: int
+        :param memory: memory size of the box, in MiB
+        :type memory: int
+        :param wait: queue the box until the resources are available,
+                     instead of rejecting it
+        :type wait: bool
+        :param timeout: maximum time to wait, in seconds
+        :type timeout: float
+
+        :returns: the identifier of the reservation
+        :rtype: str
+        """
+        self._check_budget(cpus, memory)
+        reservation = self._new_reservation(name, cpus, memory)
+        with self._locked_state() as state:
+            if self._may_overtake(state['queue']) and \
+               self._fits(state, cpus, memory):
+                state['running'].append(reservation)
+                return reservation['id']
+            if not wait:
+                raise RuntimeError(_("not enough resources on host"))
+            state['queue'].append(reservation)
+        info(_("waiting for resources to run {}").format(name))
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            while True:
+                time.sleep(self.POLL_INTERVAL)
+                with self._locked_state() as state:
+                    ids = [r['id'] for r in state['queue']]
+                    if reservation['id'] not in ids:
+                        state['queue'].append(reservation)
+                        ids.append(reservation['id'])
+                    position = ids.index(reservation['id'])
+                    if self._may_overtake(state['queue'][:position]) and \
+                       self._fits(state, cpus, memory):
+                        state['queue'].pop(position)
+                        state['running'].append(reservation)
+                        debug("admitted {}".format(name))
+                        return reservation['id']
+                if deadline and time.monotonic() > deadline:
+                    raise RuntimeError(_("timeout waiting for resources"))
+        except BaseException:
+            self.release(reservation['id'])
+            raise
+
+    def release(self, id):
+        """Releases the resources reserved for a box.
+
+        :param id: the identifier of the reservation
+        :type id: str
+        """
+        with self._locked_state() as state:
+            for key in ('running', 'queue'):
+                state[key] = [r for r in state[key] if r['id'] != id]
+
+    @contextmanager
+    def reserve(self, name, cpus, memory, wait=True, timeout=None):
+        """Reserves resources for a box, for the duration of a block.
+
+        See :meth:`admit` for the parameters.
+        """
+        id = self.admit(name, cpus, memory, wait, timeout)
+        try:
+            yield id
+        finally:
+            self.release(id)
+
+    def status(self):
+        """Returns the running and queued reservations.
+
+        :returns: the lists of reservations, indexed by 'running' and 'queue'
+        :rtype: dict
+        """
+        with self._locked_state() as state:
+            return {'running': state['running'], 'queue': state['queue']}
+
+# vim: ts=4 sw=4 sts=4 et ai
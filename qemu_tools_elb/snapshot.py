@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.snapshot
+   ```````````````````````
+
+   Saved states of virtual machines
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import json
+import shlex
+import shutil
+import hashlib
+from .logging import debug
+from .utils import get_cache_dir, write_json
+
+def compute_fingerprint(args, files):
+    """Computes the fingerprint of the inputs of a virtual machine.
+
+    :param args: the command line of QEMU
+    :type args: list of str
+    :param files: the paths to the kernel and drive images
+    :type files: list of str
+
+    :returns: the fingerprint
+    :rtype: str
+    """
+    inputs = {'args': args, 'files': []}
+    for path in files:
+        try:
+            st = os.stat(path)
+            inputs['files'].append([path, st.st_size, st.st_mtime_ns])
+        except OSError:
+            inputs['files'].append([path, None, None])
+    data = json.dumps(inputs, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+def _get_paths(box):
+    directory = box.snapshot_directory
+    if not directory:
+        directory = os.path.join(get_cache_dir(), 'snapshots')
+    base = os.path.join(directory, box.name)
+    return base + '.state', base + '.json', base + '.disks'
+
+def _read_metadata(path):
+    try:
+        with open(path) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+def get_saved_net_slot(box):
+    """Returns the network slot of the instance a box was saved from.
+
+    :param box: the box
+    :type box: :class:`Box`
+
+    :returns: the network slot, or 0 if the box has no saved state
+    :rtype: int
+    """
+    state, metadata, disks = _get_paths(box)
+    return _read_metadata(metadata).get('net-slot', 0)
+
+def remove_uncommitted(box):
+    """Removes the state of a box which is not committed, like the one left
+    by a failed saving.
+
+    :param box: the box
+    :type box: :class:`Box`
+    """
+    state, metadata, disks = _get_paths(box)
+    if not os.path.exists(metadata):
+        if os.path.exists(state):
+            os.unlink(state)
+        shutil.rmtree(disks, ignore_errors=True)
+
+class Snapshot:
+    """Represents the saved state of a box.
+
+    The state of the virtual machine is saved to a file by migrating it, and
+    restored by starting QEMU with an incoming migration from that file. The
+    state is only valid as long as the fingerprint of the command line, the
+    kernel and the drives is the same as when it was saved.
+
+    While the box boots and its state is saved, its drives are written to
+    qcow2 overlays, which are kept along with the state, so that the drives
+    of a restored instance match its memory. Each restored instance runs on
+    its own overlays, backed by the saved ones.
+
+    The MAC addresses of the virtual machine are part of its state, so the
+    network slot of the instance the state was saved from is saved too, and
+    only an instance leased the same slot may be restored.
+
+    :param box: the box
+    :type box: :class:`Box`
+    :param fingerprint: fingerprint of the inputs of the virtual machine
+    :type fingerprint: str
+    :param net_slot: network slot of the instance the state is saved from
+    :type net_slot: int
+    """
+    def __init__(self, box, fingerprint, net_slot=0):
+        self._state, self._metadata, self._disks = _get_paths(box)
+        self._fingerprint = fingerprint
+        self._net_slot = net_slot
+
+    @property
+    def filename(self):
+        """Returns the path to the state file"""
+        return self._state
+
+    @property
+    def net_slot(self):
+        """Returns the network slot of the instance the state is saved from"""
+        return self._net_slot
+
+    @property
+    def incoming_uri(self):
+        """Returns the URI to restore the state from"""
+        return "exec:cat {}".format(shlex.quote(self._state))
+
+    @property
+    def outgoing_uri(self):
+        """Returns the URI to save the state to"""
+        return "exec:cat > {}".format(shlex.quote(self._state))
+
+    def get_disk(self, bus, index):
+        """Returns the path to the saved overlay of a drive.
+
+        :param bus: 'system' or 'usb'
+        :type bus: str
+        :param index: index of the drive on its bus
+        :type index: int
+
+        :rtype: str
+        """
+        return os.path.join(self._disks, "{}-{}.qcow2".format(bus, index))
+
+    def is_valid(self):
+        """Tells if the saved state can be restored.
+
+        :rtype: bool
+        """
+        metadata = _read_metadata(self._metadata)
+        if metadata.get('fingerprint') != self._fingerprint or \
+           metadata.get('net-slot', 0) != self._net_slot:
+            debug("snapshot {} is outdated".format(self._state))
+            return False
+        return os.path.exists(self._state)
+
+    def prepare(self):
+        """Prepares the saving of a new state."""
+        self.remove()
+        os.makedirs(self._disks)
+
+    def commit(self):
+        """Marks the saved state as valid."""
+        write_json(self._metadata,
+                   {'fingerprint': self._fingerprint,
+                    'net-slot': self._net_slot})
+
+    def remove(self):
+        """Removes the saved state."""
+        for path in (self._metadata, self._state):
+            if os.path.exists(path):
+                os.unlink(path)
+        shutil.rmtree(self._disks, ignore_errors=True)
+
+# vim: ts=4 sw=4 sts=4 et ai
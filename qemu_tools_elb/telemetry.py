@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of qemu-tools-elb
+#
+# Copyright (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+   qemu_tools_elb.telemetry
+   ````````````````````````
+
+   Timing spans, events and resource usage of runs
+
+   Records are dictionaries passed to a sink, which is either a function or
+   a :class:`JsonLinesSink`. Each record has a ``type`` ('span', 'event',
+   'sample' or 'usage'), a ``name``, the wall-clock ``time`` it started at,
+   the ``pid`` of the emitting process and the attributes given by the
+   caller. Spans also have a ``duration``, in seconds. Nothing is recorded
+   until a sink is set.
+
+   :copyright: (C) 2014 Eric Le Bihan <eric.le.bihan.dev@free.fr>
+   :license: GPLv3+
+"""
+
+__docformat__ = 'restructuredtext en'
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+__sink = None
+__interval = 1.0
+
+class JsonLinesSink:
+    """Appends records to a file, as JSON objects, one per line.
+
+    The file is opened in append mode, so that it can be shared by several
+    processes.
+
+    :param filename: path to the file
+    :type filename: str
+    """
+    def __init__(self, filename):
+        self._file = open(filename, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+def set_sink(sink, interval=1.0):
+    """Sets the function receiving the records.
+
+    :param sink: function called with each record, or None to disable
+                 telemetry
+    :type sink: callable
+    :param interval: period of the sampling of the resource usage of QEMU,
+                     in seconds
+    :type interval: float
+    """
+    global __sink, __interval
+    __sink = sink
+    __interval = interval
+
+def setup_telemetry(filename=None):
+    """Sets up telemetry to a JSON-lines file.
+
+    The file defaults to the value of $QEMU_BOX_TELEMETRY. Telemetry is
+    disabled if there is no file. The sampling period can be set, in seconds,
+    in $QEMU_BOX_TELEMETRY_INTERVAL.
+
+    :param filename: path to the file
+    :type filename: str
+    """
+    filename = filename or os.environ.get('QEMU_BOX_TELEMETRY')
+    if filename:
+        interval = os.environ.get('QEMU_BOX_TELEMETRY_INTERVAL', '1.0')
+        set_sink(JsonLinesSink(filename), float(interval))
+
+def is_enabled():
+    """Tells if records are collected.
+
+    :rtype: bool
+    """
+    return __sink is not None
+
+def emit(type, name, **attrs):
+    """Passes a record to the sink.
+
+    :param type: type of the record
+    :type type: str
+    :param name: name of the record
+    :type name: str
+    """
+    sink = __sink
+    if sink is None:
+        return
+    record = {'type': type, 'name': name, 'time': time.time(), 'pid': os.getpid()}
+    record.update(attrs)
+    sink(record)
+
+def event(name, **attrs):
+    """Records an event.
+
+    :param name: name of the event
+    :type name: str
+    """
+    emit('event', name, **attrs)
+
+@contextmanager
+def span(name, **attrs):
+    """Records the duration of a block.
+
+    :param name: name of the span
+    :type name: str
+    """
+    if __sink is None:
+        yield
+        return
+    start = time.time()
+    clock = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        attrs['duration'] = time.perf_counter() - clock
+        if error:
+            attrs['error'] = error
+        sink = __sink
+        if sink is not None:
+            record = {'type': 'span', 'name': name, 'time': start, 'pid': os.getpid()}
+            record.update(attrs)
+            sink(record)
+
+def read_proc_usage(pid):
+    """Reads the resource usage of a process from /proc.
+
+    :param pid: the process identifier
+    :type pid: int
+
+    :returns: the CPU time in seconds, the resident set size and its peak in
+              KiB, and the bytes read and written, if available
+    :rtype: dict
+    """
+    usage = {}
+    with open("/proc/{}/stat".format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    usage['cpu'] = (int(fields[11]) + int(fields[12])) / ticks
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                usage['rss'] = int(line.split()[1])
+            elif line.startswith('VmHWM:'):
+                usage['rss_peak'] = int(line.split()[1])
+    try:
+        with open("/proc/{}/io".format(pid)) as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in ('read_bytes', 'write_bytes'):
+                    usage[key] = int(value)
+    except OSError:
+        pass
+    return usage
+
+class ProcSampler:
+    """Samples the resource usage of a process periodically, in a thread.
+
+    A 'sample' record is emitted at each period, and a 'usage' record with
+    the last values when the sampler is stopped.
+
+    :param pid: the process identifier
+    :type pid: int
+    :param interval: sampling period, in seconds
+    :type interval: float
+    """
+    def __init__(self, pid, interval, **attrs):
+        self._pid = pid
+        self._interval = interval
+        self._attrs = attrs
+        self._last = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        try:
+            self._last = read_proc_usage(self._pid)
+        except (OSError, ValueError, IndexError):
+            return None
+        return self._last
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            usage = self._sample()
+            if usage is None:
+                break
+            emit('sample', 'qemu', qemu_pid=self._pid, **usage, **self._attrs)
+
+    def stop(self):
+        """Stops sampling and records the last known usage."""
+        self._stopped.set()
+        self._thread.join()
+        if self._last is not None:
+            emit('usage', 'qemu', qemu_pid=self._pid, **self._last, **self._attrs)
+
+def start_sampler(pid, **attrs):
+    """Starts sampling the resource usage of a process, if telemetry is
+    enabled.
+
+    :param pid: the process identifier
+    :type pid: int
+
+    :returns: the sampler, or None
+    :rtype: :class:`ProcSampler`
+    """
+    if __sink is None:
+        return None
+    return ProcSampler(pid, __interval, **attrs)
+
+# vim: ts=4 sw=4 sts=4 et ai
@@ -29,7 +29,14 @@
 """
 
 import os
+import json
+import stat
+import fcntl
+import atexit
+import threading
+from contextlib import contextmanager
 from gettext import bindtextdomain, textdomain
+from gettext import gettext as _
 
 def get_data_dir():
     """Returns the data directory.
@@ -47,6 +54,302 @@ def get_data_dir():
 
     return os.path.normpath(data_dir)
 
+def get_cache_dir():
+    """Returns the cache directory.
+
+    The location honors the $XDG_CACHE_HOME environment variable.
+
+    rtype: str
+    """
+    root_dir = os.environ.get('XDG_CACHE_HOME', '')
+    if not root_dir:
+        root_dir = os.path.expanduser('~/.cache')
+    return os.path.join(root_dir, 'qemu-box')
+
+def get_runtime_dir():
+    """Returns the directory for runtime files, like sockets.
+
+    The location honors the $XDG_RUNTIME_DIR environment variable.
+
+    rtype: str
+    """
+    root_dir = os.environ.get('XDG_RUNTIME_DIR', '')
+    if root_dir:
+        return os.path.join(root_dir, 'qemu-box')
+    return os.path.join('/tmp', "qemu-box-{}".format(os.getuid()))
+
+SHARED_STATE_DIR = '/run/qemu-box'
+
+def get_state_dir():
+    """Returns the directory for the state shared by the instances of
+    qemu-box, like the network slots of the running boxes.
+
+    The location honors the $QEMU_BOX_STATE_DIR environment variable.
+    Otherwise, /run/qemu-box is used if the administrator created it, so that
+    all the users of the host share the state, or the runtime directory of
+    the user.
+
+    rtype: str
+    """
+    root_dir = os.environ.get('QEMU_BOX_STATE_DIR', '')
+    if root_dir:
+        return root_dir
+    if os.path.isdir(SHARED_STATE_DIR):
+        return SHARED_STATE_DIR
+    return os.path.join(get_runtime_dir(), 'state')
+
+def get_host_memory():
+    """Returns the amount of physical memory of the host.
+
+    :returns: the size of the memory in MiB
+    :rtype: int
+    """
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) // 1024
+    raise RuntimeError(_("can not read memory size"))
+
+def parse_cpu_list(text):
+    """Parses a list of CPUs, like "0-3,8".
+
+    :param text: the list of CPUs
+    :type text: str
+
+    :returns: the CPU numbers
+    :rtype: set of int
+    """
+    cpus = set()
+    try:
+        for item in text.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            if '-' in item:
+                first, last = item.split('-', 1)
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(item))
+    except ValueError:
+        raise RuntimeError(_("invalid CPU list '{}'").format(text))
+    return cpus
+
+def get_numa_node_cpus(node):
+    """Returns the CPUs of a NUMA node of the host.
+
+    :param node: number of the NUMA node
+    :type node: int
+
+    :returns: the CPU numbers
+    :rtype: set of int
+    """
+    path = "/sys/devices/system/node/node{}/cpulist".format(node)
+    try:
+        with open(path) as f:
+            return parse_cpu_list(f.read())
+    except OSError:
+        raise RuntimeError(_("unknown NUMA node {}").format(node))
+
+def is_process_alive(pid):
+    """Tells if a process is running.
+
+    :param pid: the process identifier
+    :type pid: int
+
+    :rtype: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read_json(path):
+    """Reads a JSON file.
+
+    :param path: path to the file
+    :type path: str
+
+    :returns: the data, or None if the file is missing or invalid
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json(path, data, mode=None):
+    """Writes a JSON file atomically.
+
+    The data is written to a temporary file, which then replaces the file,
+    so that readers never see a partial file.
+
+    :param path: path to the file
+    :type path: str
+    :param data: the data
+    :param mode: permissions of the file, if not the default ones
+    :type mode: int
+    """
+    # Imported on demand, like the logging below, as qemu-box imports this
+    # module at start-up
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                               suffix='.tmp',
+                               dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            if mode is not None:
+                os.fchmod(f.fileno(), mode)
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def _check_state_dir(path, group=None):
+    # A state directory must not be writable by all the users, nor owned by
+    # another user than root, unless it belongs to the group sharing it.
+    st = os.lstat(path)
+    trusted = st.st_uid in (0, os.getuid()) or \
+        (group is not None and st.st_gid == group)
+    if not stat.S_ISDIR(st.st_mode) or st.st_mode & stat.S_IWOTH or not trusted:
+        raise RuntimeError(_("unsafe state directory {}").format(path))
+    return st
+
+def _open_lock_file(path, mode):
+    flags = os.O_RDWR | os.O_NOFOLLOW
+    try:
+        fd = os.open(path, flags | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        return os.open(path, flags)
+    if mode is not None:
+        os.fchmod(fd, mode)
+    return fd
+
+@contextmanager
+def locked_json_state(directory, filename, shared=False):
+    """Gives exclusive access to a state shared between processes.
+
+    The state, a dictionary, is stored as a JSON file in a directory, along
+    with a lock file. It is read once the lock is taken, and written back
+    when leaving the context, unless an exception is raised.
+
+    The directory is rejected if it is writable by all the users or owned by
+    another user. If it is shared, its parent directory is checked too, and
+    if the parent is writable by its group, like a /run/qemu-box directory
+    created by the administrator for the users of qemu-box, the directory
+    and its files are made writable by this group.
+
+    :param directory: path to the state directory
+    :type directory: str
+    :param filename: name of the state file
+    :type filename: str
+    :param shared: share the directory with the group of its parent
+    :type shared: bool
+
+    :returns: the state
+    :rtype: dict
+    """
+    group = None
+    mode = None
+    if shared:
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, mode=0o700, exist_ok=True)
+        st = _check_state_dir(parent)
+        if st.st_mode & stat.S_IWGRP:
+            group = st.st_gid
+            mode = 0o660
+    if not os.path.lexists(directory):
+        try:
+            os.makedirs(directory, mode=0o700)
+        except FileExistsError:
+            pass
+        else:
+            if group is not None:
+                os.chown(directory, -1, group)
+                os.chmod(directory, 0o2770)
+    _check_state_dir(directory, group)
+    fd = _open_lock_file(os.path.join(directory, 'lock'), mode)
+    with open(fd, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(directory, filename)
+        state = read_json(path)
+        if not isinstance(state, dict):
+            state = {}
+        yield state
+        write_json(path, state, mode)
+
+class JsonCache:
+    """Base class of the caches stored in a JSON file.
+
+    The file holds the version of the format of the cache, and is discarded
+    if it does not match :attr:`VERSION`. Subclasses restore their entries
+    from the data in :meth:`_restore`, return them in :meth:`_dump` and call
+    :meth:`_set_dirty` after modifying them, while holding :attr:`_lock`.
+
+    The cache can be shared between threads.
+
+    :param filename: path to the cache file
+    :type filename: str
+    """
+    VERSION = 1
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._dirty = False
+        self._registered = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _set_dirty(self):
+        self._dirty = True
+        if not self._registered:
+            atexit.register(self.save)
+            self._registered = True
+
+    @property
+    def filename(self):
+        """Returns the path to the cache file"""
+        return self._filename
+
+    def _restore(self, data):
+        raise NotImplementedError
+
+    def _dump(self):
+        raise NotImplementedError
+
+    def _load(self):
+        from .logging import debug
+        data = read_json(self._filename)
+        if data is None:
+            return
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            debug("discarding outdated cache {}".format(self._filename))
+            return
+        self._restore(data)
+
+    def save(self):
+        """Writes the cache back to disk, if it was modified.
+
+        This is done automatically on exit for pending modifications. Failing
+        to write the cache is not fatal: it will be rebuilt on next run.
+        """
+        from .logging import debug
+        with self._lock:
+            if not self._dirty:
+                return
+            data = self._dump()
+            data['version'] = self.VERSION
+            try:
+                os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+                write_json(self._filename, data)
+                self._dirty = False
+            except OSError as e:
+                debug("can not write cache {}: {}".format(self._filename, e))
+
 def setup_i18n():
     """Set up internationalization."""
     root_dir = os.path.dirname(os.path.abspath(__file__))